@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# Benchmarks of texp on synthetic documents, one workload for each of the
+# hot paths of the expander.  Every workload is run at a few sizes; the
+# throughput, the peak memory and how the time grows with the size are
+# written as JSON, so that runs on different commits can be compared:
+#
+#     ./bench.py --out before.json
+#     ./bench.py --out after.json --compare before.json
+
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from texp import Profiler, TeXOutputStdout, TeXError
+
+def names(n):
+    # n distinct control sequence names made of letters
+    for i in range(n):
+        name = ''
+        while True:
+            name += chr(ord('a') + i % 26)
+            i //= 26
+            if i == 0: break
+        yield 'm' + name
+
+def text(n):
+    line = 'The quick brown fox jumps over the lazy dog, again and again.\n'
+    return line * n
+
+def recursion(n):
+    return ('\\def\\rep#1{\\ifx#1\\end\\else[#1]\\expandafter\\rep\\fi}%\n' +
+            '\\rep ' + 'abcdefghij' * n + '\\end\n')
+
+def defs(n):
+    return ''.join('\\def\\%s#1{(#1)}\\%s{x}\n' % (name, name) for name in names(n))
+
+def iffalse(n):
+    block = '\\iffalse\n' + 'Skipped text with a \\macro and {groups} in it.\n' * 20 + '\\fi kept\n'
+    return block * n
+
+def delimited(n):
+    return ('\\def\\upto#1\\stop{[#1]}%\n' +
+            ('\\upto ' + 'word ' * 200 + '\\stop\n') * n)
+
+def csname(n):
+    return ''.join('\\expandafter\\def\\csname cs %s\\endcsname{%s}\\csname cs %s\\endcsname\n'
+                   % (name, name, name) for name in names(n))
+
+def catcode(n):
+    return ('\\catcode`\\@=11 \\def\\in@ner{inner}\\in@ner\\catcode`\\@=12 @ text\n') * n
+
+def nested_input(n, directory, depth=4):
+    # \input of a chain of `depth` files, n times
+    for level in range(depth):
+        with open(os.path.join(directory, 'level%d.tex' % level), 'w') as handle:
+            handle.write('Level %d text.\n' % level)
+            if level + 1 < depth:
+                handle.write('\\input %s \n' % os.path.join(directory, 'level%d.tex' % (level + 1)))
+    return ('\\input %s \n' % os.path.join(directory, 'level0.tex')) * n
+
+workloads = {
+    'text': text,
+    'recursion': recursion,
+    'defs': defs,
+    'iffalse': iffalse,
+    'delimited': delimited,
+    'csname': csname,
+    'catcode': catcode,
+    'input': nested_input,
+}
+
+def discard(chunk):
+    pass
+
+def run(source):
+    t = TeXOutputStdout(source, output=discard)
+    t.process()
+    if t.diagnostic() is not None:
+        raise TeXError(t.diagnostic())
+    return t
+
+def count_tokens(source):
+    # The tokens that were tokenized or produced by expansions
+    t = TeXOutputStdout(source, output=discard)
+    profiler = Profiler(t)
+    profiler.enable()
+    t.process()
+    profiler.disable()
+    return sum(stats[1] for stats in profiler.stats.values())
+
+def peak_memory(source):
+    tracemalloc.start()
+    try:
+        run(source)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def measure(source, repeat):
+    seconds = min(timed(source) for _ in range(repeat))
+    tokens = count_tokens(source)
+    return {
+        'chars': len(source),
+        'tokens': tokens,
+        'seconds': seconds,
+        'chars_per_s': len(source) / seconds,
+        'tokens_per_s': tokens / seconds,
+        'peak_bytes': peak_memory(source),
+    }
+
+def timed(source):
+    start = time.perf_counter()
+    run(source)
+    return time.perf_counter() - start
+
+def exponent(points):
+    # The slope of log(seconds) against log(chars): 1 for linear scaling
+    xs = [math.log(p['chars']) for p in points]
+    ys = [math.log(p['seconds']) for p in points]
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+    sxx = sum((x - mx) ** 2 for x in xs)
+    if sxx == 0:
+        return None
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark(only=None, scale=100, steps=3, repeat=3, report=sys.stdout):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, make in workloads.items():
+            if only and name not in only:
+                continue
+            points = []
+            for k in range(steps):
+                n = scale * 2 ** k
+                source = make(n, directory) if name == 'input' else make(n)
+                point = measure(source, repeat)
+                point['size'] = n
+                points.append(point)
+                report.write('%-10s %8d %10d chars %8.3fs %12.0f chars/s %12.0f tokens/s %10d bytes\n' % (
+                    name, n, point['chars'], point['seconds'], point['chars_per_s'],
+                    point['tokens_per_s'], point['peak_bytes']))
+            results[name] = {'points': points, 'exponent': exponent(points)}
+            if results[name]['exponent'] is not None:
+                report.write('%-10s scaling exponent %.2f\n' % (name, results[name]['exponent']))
+    return {'commit': commit(), 'python': sys.version.split()[0], 'time': time.time(), 'results': results}
+
+def compare(new, old, report=sys.stdout):
+    # Throughput at the largest common size, relative to `old`
+    report.write('\n%-10s %12s %12s %8s %10s\n' % ('workload', 'chars/s', 'before', 'ratio', 'exponent'))
+    for name, result in new['results'].items():
+        before = old['results'].get(name)
+        if before is None:
+            continue
+        sizes = {p['size']: p for p in before['points']}
+        common = [p for p in result['points'] if p['size'] in sizes]
+        if not common:
+            continue
+        p = common[-1]
+        q = sizes[p['size']]
+        report.write('%-10s %12.0f %12.0f %8.2f %10s\n' % (
+            name, p['chars_per_s'], q['chars_per_s'], p['chars_per_s'] / q['chars_per_s'],
+            '%.2f/%.2f' % (result['exponent'] or 0, before['exponent'] or 0)))
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description='Benchmark texp on synthetic documents.')
+    parser.add_argument('workload', nargs='*', help='the workloads to run, all of %s by default' % ', '.join(workloads))
+    parser.add_argument('--scale', type=int, default=100, help='the size of the smallest document')
+    parser.add_argument('--steps', type=int, default=3, help='the number of sizes, each twice the previous')
+    parser.add_argument('--repeat', type=int, default=3, help='time the best of this many runs')
+    parser.add_argument('--out', help='write the results to a JSON file')
+    parser.add_argument('--compare', metavar='JSON', help='compare with the results of an earlier run')
+    args = parser.parse_args()
+    unknown = set(args.workload) - set(workloads)
+    if unknown:
+        parser.error('unknown workload %s' % ', '.join(sorted(unknown)))
+    results = benchmark(args.workload, args.scale, args.steps, args.repeat)
+    if args.out:
+        with open(args.out, 'w') as handle:
+            json.dump(results, handle, indent=1)
+    if args.compare:
+        with open(args.compare) as handle:
+            compare(results, json.load(handle))
@@ -1,37 +1,771 @@
 #!/usr/bin/env python3
 
-from collections import namedtuple
+import hashlib
+import io
+import locale
+import math
+import mmap
+import os
+import pickle
+import re
+import sys
+import time
+from collections import OrderedDict, namedtuple
 
 class MapStack():
+    # Bindings live in a single dict.  The first assignment to a name inside
+    # a group records the binding it replaces on the save stack, and pop()
+    # puts the recorded bindings back when the group ends.
+    #
+    # freeze() turns the bindings into a read-only layer that can be shared
+    # by other MapStacks (see thaw), and new bindings are made in front of
+    # it.  Names found in the frozen layers are copied into `map` when they
+    # are first used, where `unbound` also marks names that are not bound.
+    unbound = object()
+    max_layers = 8
     def __init__(self):
-        self.map = [{}]
+        self.map = {}
+        self.saved = []
+        self.frozen = None
     def __getitem__(self, name):
-        for x in reversed(self.map):
-            if name in x:
-                return x[name]
-        raise KeyError()
+        value = self.get(name, self.unbound)
+        if value is self.unbound:
+            raise KeyError(name)
+        return value
     def __contains__(self, name):
-        for x in reversed(self.map):
-            if name in x:
-                return True
-        return False
+        return self.get(name, self.unbound) is not self.unbound
+    def get(self, name, default=None):
+        try:
+            value = self.map[name]
+        except KeyError:
+            if self.frozen is None:
+                return default
+            value = self.map[name] = self.lookup(name)
+        if value is self.unbound:
+            return default
+        return value
+    def lookup(self, name):
+        layer = self.frozen
+        while layer is not None:
+            (bindings, layer) = layer
+            if name in bindings:
+                return bindings[name]
+        return self.unbound
     def __setitem__(self, name, value):
-        self.map[-1][name] = value
+        if self.saved:
+            saved = self.saved[-1]
+            if name not in saved:
+                saved[name] = self.get(name, self.unbound)
+        self.map[name] = value
+    def depth(self):
+        return len(self.saved)
     def pop(self):
-        self.map.pop()
+        for name, value in self.saved.pop().items():
+            if value is self.unbound and self.frozen is None:
+                del self.map[name]
+            else:
+                self.map[name] = value
     def push(self):
-        self.map.append({})
+        self.saved.append({})
+    def flatten(self):
+        layers = []
+        layer = self.frozen
+        while layer is not None:
+            layers.append(layer[0])
+            layer = layer[1]
+        bindings = {}
+        for layer in reversed(layers):
+            bindings.update(layer)
+        bindings.update(self.map)
+        return {name: value for name, value in bindings.items() if value is not self.unbound}
+    def items(self):
+        if self.frozen is None:
+            return self.map.items()
+        return self.flatten().items()
+    def freeze(self):
+        # Only the bindings outside of groups are frozen.
+        assert not self.saved
+        if self.map:
+            self.frozen = (self.map, self.frozen)
+            self.map = {}
+            layers = 0
+            layer = self.frozen
+            while layer is not None:
+                layers += 1
+                layer = layer[1]
+            if layers > self.max_layers:
+                self.frozen = (self.flatten(), None)
+        return self.frozen
+    def thaw(self, frozen):
+        # Replaces all bindings by the frozen ones.
+        self.map = {}
+        self.saved = []
+        self.frozen = frozen
+
+class TokenQueue():
+    # Tokens are kept in `buf` from index `head` onwards.  Removing tokens
+    # from the front only moves `head`; the consumed prefix is discarded once
+    # it makes up more than half of the buffer.
+    def __init__(self, tokens=()):
+        self.buf = list(tokens)
+        self.head = 0
+    def __len__(self):
+        return len(self.buf) - self.head
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self.buf) - self.head)
+            return self.buf[self.head + start:self.head + stop:step]
+        if idx < 0:
+            idx += len(self.buf) - self.head
+            if idx < 0: raise IndexError(idx)
+        return self.buf[self.head + idx]
+    def __iter__(self):
+        for i in range(self.head, len(self.buf)):
+            yield self.buf[i]
+    def __repr__(self):
+        return repr(self.buf[self.head:])
+    def append(self, token):
+        self.buf.append(token)
+    def extend(self, tokens):
+        self.buf.extend(tokens)
+    def truncate(self, n):
+        # remove the last n tokens
+        del self.buf[len(self.buf) - n:]
+    def popleft(self):
+        t = self.buf[self.head]
+        self.drop(1)
+        return t
+    def drop(self, n=1):
+        self.head += n
+        if self.head >= len(self.buf):
+            self.buf = []
+            self.head = 0
+        elif self.head > 1024 and 2 * self.head > len(self.buf):
+            del self.buf[:self.head]
+            self.head = 0
+
+class InputStack():
+    # Tokens still to be read, TeX's input stack.  Every expansion is pushed
+    # as a layer [tokens, position] on top of `bottom`, the queue the
+    # tokenizer appends to.  A layer is popped as soon as it is read to the
+    # end, so a tail call does not leave an empty layer behind.
+    def __init__(self, tokens=()):
+        self.bottom = TokenQueue(tokens)
+        self.layers = []
+        self.pending = 0 # number of tokens in the layers
+    def __len__(self):
+        return self.pending + len(self.bottom)
+    def __getitem__(self, idx):
+        if not self.layers:
+            return self.bottom[idx]
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            toks = []
+            for t in self.iter_from(start):
+                if len(toks) >= stop - start: break
+                toks.append(t)
+            return toks[::step]
+        if idx < 0:
+            idx += len(self)
+            if idx < 0: raise IndexError(idx)
+        for layer in reversed(self.layers):
+            n = len(layer[0]) - layer[1]
+            if idx < n:
+                return layer[0][layer[1] + idx]
+            idx -= n
+        return self.bottom[idx]
+    def iter_from(self, idx):
+        for layer in reversed(self.layers):
+            ts, pos = layer
+            n = len(ts) - pos
+            if idx < n:
+                for i in range(pos + idx, len(ts)):
+                    yield ts[i]
+                idx = 0
+            else:
+                idx -= n
+        buf = self.bottom.buf
+        for i in range(self.bottom.head + idx, len(buf)):
+            yield buf[i]
+    def __iter__(self):
+        return self.iter_from(0)
+    def __repr__(self):
+        return repr(list(self))
+    def append(self, token):
+        self.bottom.append(token)
+    def extend(self, tokens):
+        self.bottom.extend(tokens)
+    def drop(self, n=1):
+        layers = self.layers
+        while n > 0 and layers:
+            layer = layers[-1]
+            k = len(layer[0]) - layer[1]
+            if n < k:
+                layer[1] += n
+                self.pending -= n
+                return
+            layers.pop()
+            self.pending -= k
+            n -= k
+        if n > 0:
+            self.bottom.drop(n)
+    def push(self, tokens):
+        # `tokens` is not copied and must not be modified afterwards
+        if len(tokens) > 0:
+            self.layers.append([tokens, 0])
+            self.pending += len(tokens)
+
+class StringSource():
+    # Input read from a string.  A source does not change while it is read,
+    # the reader keeps the offset of the next line, see TeX.input_pos.
+    closed = True # no more text can arrive, see StreamSource
+    def __init__(self, text):
+        self.text = text
+    def at_end(self, pos):
+        return pos >= len(self.text)
+    def readline(self, pos):
+        # Returns the line starting at `pos`, including the newline if there
+        # is one, and the offset of the next line.
+        i = self.text.find('\n', pos)
+        i = len(self.text) if i < 0 else i + 1
+        return self.text[pos:i], i
+    def peek(self, pos, size):
+        return self.text[pos:pos + size]
+
+class StreamSource():
+    # Input that arrives in pieces, see TeX.feed.  Only complete lines are
+    # read until the stream is closed, so a line is never tokenized before
+    # its end is known.  Text that has been read is discarded once it makes
+    # up more than half of the buffer; `base` is the offset of the buffer in
+    # the stream.
+    def __init__(self):
+        self.text = ''
+        self.base = 0
+        self.closed = False
+    def feed(self, text):
+        if self.closed:
+            raise ValueError('Input fed to a closed stream')
+        self.text += text
+    def close(self):
+        self.closed = True
+    def at_end(self, pos):
+        pos -= self.base
+        return pos >= len(self.text) or (not self.closed and self.text.find('\n', pos) < 0)
+    def readline(self, pos):
+        pos -= self.base
+        i = self.text.find('\n', pos)
+        i = len(self.text) if i < 0 else i + 1
+        line = self.text[pos:i]
+        if 2 * i > len(self.text):
+            self.text = self.text[i:]
+            self.base += i
+            i = 0
+        return line, self.base + i
+    def peek(self, pos, size):
+        pos -= self.base
+        return self.text[pos:pos + size]
+
+class FileSource():
+    # Input read from a memory mapped file, offsets are in bytes.  Lines are
+    # decoded one at a time, so the file is never held in memory as a string.
+    closed = True
+    def __init__(self, filename, encoding=None):
+        with open(filename, 'rb') as handle:
+            try:
+                self.data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # empty files cannot be mapped
+                self.data = b''
+        self.encoding = encoding or locale.getpreferredencoding(False)
+    def at_end(self, pos):
+        return pos >= len(self.data)
+    def readline(self, pos):
+        i = self.data.find(b'\n', pos)
+        i = len(self.data) if i < 0 else i + 1
+        line = self.data[pos:i]
+        if line.endswith(b'\r\n'):
+            line = line[:-2] + b'\n'
+        return line.decode(self.encoding), i
+    def peek(self, pos, size):
+        return self.data[pos:pos + 4 * size].decode(self.encoding, 'ignore')[:size]
+
+class OutputSink():
+    # Collects output and passes it on in chunks: at the end of every
+    # paragraph, when `limit` pieces have been collected and when a run ends.
+    # `target` is a text or binary file, or a function that is called with
+    # each chunk; by default output goes to sys.stdout.
+    def __init__(self, target=None, limit=4096, encoding='utf-8'):
+        self.target = target
+        self.limit = limit
+        self.encoding = encoding
+        self.parts = []
+    def write(self, text):
+        self.parts.append(text)
+        if len(self.parts) >= self.limit:
+            self.flush()
+    def flush(self):
+        if len(self.parts) == 0: return
+        chunk = ''.join(self.parts)
+        self.parts = []
+        target = self.target
+        if target is None:
+            sys.stdout.write(chunk)
+        elif not hasattr(target, 'write'):
+            target(chunk)
+        elif isinstance(target, (io.RawIOBase, io.BufferedIOBase)) or 'b' in getattr(target, 'mode', ''):
+            target.write(chunk.encode(self.encoding))
+        else:
+            target.write(chunk)
+
+class TokenCache():
+    # Tokens of the lines of \input files, keyed by the file's path,
+    # modification time and size and by the category codes in effect when
+    # the file was opened.  Only lines that were tokenized with those
+    # category codes are kept, with the state the scanner ended in.  With a
+    # `directory` the lines are also saved there by save() and read back by
+    # later runs.
+    version = 2 # of the saved lines
+    def __init__(self, directory=None, limit=256):
+        self.directory = directory
+        self.limit = limit
+        self.files = OrderedDict()
+        self.changed = set()
+    def key(self, filename, catcodes):
+        stat = os.stat(filename)
+        return (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, catcodes.fingerprint())
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr((self.version, key)).encode('utf-8')).hexdigest() + '.tokens')
+    def lines(self, key):
+        # The dict of tokenized lines for a file, by line number.  Lines are
+        # added to it by add() while the file is read.
+        lines = self.files.get(key)
+        if lines is None:
+            lines = self.load(key)
+            self.files[key] = lines
+            if len(self.files) > self.limit:
+                self.changed.discard(self.files.popitem(last=False)[0])
+        else:
+            self.files.move_to_end(key)
+        return lines
+    def add(self, key, n, toks, state):
+        lines = self.files.get(key)
+        if lines is not None:
+            lines[n] = (toks, state)
+            self.changed.add(key)
+    def load(self, key):
+        if self.directory is not None:
+            try:
+                with open(self.path(key), 'rb') as handle:
+                    lines = pickle.load(handle)
+                # tokens are shared within the file, see token
+                table = {}
+                return {n: ([table.setdefault(t, t) for t in toks], state) for n, (toks, state) in lines.items()}
+            except (OSError, pickle.PickleError, EOFError):
+                pass
+        return {}
+    def save(self):
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            for key in self.changed:
+                path = self.path(key)
+                temporary = '%s.%d.tmp' % (path, os.getpid())
+                with open(temporary, 'wb') as handle:
+                    pickle.dump(self.files[key], handle, pickle.HIGHEST_PROTOCOL)
+                os.replace(temporary, path)
+        self.changed.clear()
+
+class ExpansionCache():
+    # Full expansions of macros, see TeX.memoized_expansion.  An entry is
+    # keyed by the id of a definition and the arguments it was called with,
+    # and holds the definition, the (name, definition) pairs that were looked
+    # up to expand it and the tokens, or None if the expansion can not be
+    # memoized.  The entry is used only while those names still have those
+    # definitions, so a cache can be shared by TeXs that start from the same
+    # format.  Only the `limit` most recently used entries are kept.
+    def __init__(self, limit=4096, max_tokens=1024, max_arguments=64, attempts=8):
+        self.entries = OrderedDict()
+        self.limit = limit
+        self.max_tokens = max_tokens
+        self.max_arguments = max_arguments
+        # a definition that could not be memoized for `attempts` different
+        # arguments in a row is not tried again; the count is kept on its
+        # template, so that it goes away with the definition
+        self.attempts = attempts
+        self.hits = 0
+        self.misses = 0
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+    def put(self, key, entry):
+        self.entries[key] = entry
+        if len(self.entries) > self.limit:
+            self.entries.popitem(last=False)
+        template = entry[0].template
+        if entry[2] is not None:
+            template.memo_failures = 0
+        else:
+            template.memo_failures += 1
+    def hopeless(self, defn):
+        return defn.template.memo_failures >= self.attempts
+
+class Profiler():
+    # Times the steps of a TeX by the token they start with: a control
+    # sequence or active character, a primitive such as \def (its command
+    # step counts towards the same name), '<text>' for characters that are
+    # output and '<tokenize>' for reading input.  For every name it keeps
+    # the number of expansions, the tokens they produced, the time spent in
+    # its own steps, the cumulative time until its expansion (or for \input,
+    # the file) has been read and the longest argument text it consumed.
+    #
+    # The expansions being read form the logical call stack of the macros.
+    # As in TeX, a macro whose expansion ends in a call to another is not
+    # on the stack of that call.
+    # With stacks='exact' the time of every step is added to the stack it
+    # was taken in, with stacks='sample' the stack is sampled every
+    # `interval` seconds of CPU time; dump_collapsed writes either in the
+    # collapsed format of flame graph tools.
+    #
+    # enable() replaces the step, tokenize and expand methods of the TeX, so
+    # a TeX that is not profiled runs exactly as before.
+    def __init__(self, t, clock=time.perf_counter, stacks=None, interval=0.001):
+        self.t = t
+        self.clock = clock
+        self.stats = {} # name -> [expansions, tokens, self, cumulative, max argument]
+        self.active = [] # expansions being read, see close_expansions
+        self.stack = () # the names of the expansions in self.active
+        self.depth = {} # name -> number of its expansions in self.active
+        self.tokenized = 0
+        if stacks not in (None, 'exact', 'sample'):
+            raise ValueError("stacks must be None, 'exact' or 'sample'")
+        self.stacks = stacks
+        self.interval = interval
+        self.flames = {} # stack -> seconds or samples
+        self.current = None # the name of the step being taken
+        self.handler = None
+    def enable(self):
+        self.t.step = self.step
+        self.t.tokenize = self.tokenize
+        self.t.expand = self.expand
+        if self.stacks == 'sample':
+            import signal
+            if not hasattr(signal, 'setitimer'):
+                raise ValueError('Sampling needs signal.setitimer')
+            self.handler = signal.signal(signal.SIGPROF, self.sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+    def disable(self):
+        if self.stacks == 'sample':
+            import signal
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self.handler)
+        del self.t.step
+        del self.t.tokenize
+        del self.t.expand
+        self.close_expansions(self.clock(), True)
+    def sample(self, signum, frame):
+        if self.current is not None:
+            stack = self.stack + (self.current,)
+            self.flames[stack] = self.flames.get(stack, 0) + 1
+    def frame(self, token):
+        # The name a step starting with `token` is counted under, whether
+        # it expands the token and whether it reads arguments.
+        t = self.t
+        (name, cat) = token
+        if cat == t.control_sequence or cat == t.command:
+            return ('\\' + name, cat != t.command, True)
+        if cat == t.active:
+            return (name, True, True)
+        return ('<text>', False, False)
+    def stats_of(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = [0, 0, 0.0, 0.0, 0]
+        return stats
+    def expand(self):
+        # Expansions made inside a step, by \expandafter, \csname or while a
+        # number or file name is read, are read as expansions of their own.
+        t = self.t
+        tokens = t.tokens
+        if len(tokens) == 0:
+            return type(t).expand(t)
+        (name, expansion, _) = self.frame(tokens[0])
+        layers = tokens.layers
+        top = layers[-1] if layers else None
+        start = self.clock()
+        result = type(t).expand(t)
+        if t.tokens is tokens and layers and layers[-1] is not top and layers[-1][1] == 0:
+            stats = self.stats_of(name)
+            stats[0] += 1
+            stats[1] += len(layers[-1][0])
+            self.open_expansion(name, start, (tokens, len(layers) - 1, layers[-1]))
+        return result
+    def tokenize(self):
+        # Tokenizing done by lookahead inside a step, counted to find out
+        # how many tokens the step consumed.
+        t = self.t
+        before = len(t.tokens)
+        result = type(t).tokenize(t)
+        self.tokenized += len(t.tokens) - before
+        return result
+    def step(self):
+        t = self.t
+        tokens = t.tokens
+        before = len(tokens)
+        if before == 0:
+            (name, expansion, arguments) = ('<tokenize>', False, False)
+        else:
+            (name, expansion, arguments) = self.frame(tokens[0])
+        stack = self.stack
+        self.current = name
+        layers = tokens.layers
+        top = layers[-1] if layers else None
+        inputs = len(t.token_state)
+        self.tokenized = 0
+        start = self.clock()
+        result = type(t).step(t)
+        end = self.clock()
+        self.current = None
+        if self.stacks == 'exact':
+            stack += (name,)
+            self.flames[stack] = self.flames.get(stack, 0) + end - start
+        stats = self.stats_of(name)
+        if expansion:
+            stats[0] += 1
+        stats[2] += end - start
+        pushed = None
+        if t.tokens is tokens:
+            after = len(tokens)
+            if layers and layers[-1] is not top and layers[-1][1] == 0:
+                pushed = layers[-1]
+                produced = len(pushed[0])
+            else:
+                produced = max(0, after - before - self.tokenized)
+            stats[1] += produced
+            if arguments:
+                stats[4] = max(stats[4], before + self.tokenized - after + produced - 1)
+        self.close_expansions(end, False)
+        if pushed is not None:
+            self.open_expansion(name, start, (tokens, len(layers) - 1, pushed))
+        elif len(t.token_state) > inputs:
+            self.open_expansion(name, start, inputs)
+        elif self.depth.get(name, 0) == 0:
+            stats[3] += end - start
+        return result
+    def open_expansion(self, name, start, marker):
+        # `marker` is the input stack, depth and layer of an expansion, or
+        # the depth of the \input stack before a file was opened.
+        self.active.append((name, start, marker))
+        self.stack += (name,)
+        self.depth[name] = self.depth.get(name, 0) + 1
+    def close_expansions(self, now, all):
+        t = self.t
+        active = self.active
+        while active:
+            (name, start, marker) = active[-1]
+            if not all:
+                if isinstance(marker, int):
+                    if len(t.token_state) > marker: break
+                else:
+                    (tokens, depth, layer) = marker
+                    if tokens is not t.tokens: break # suspended by \input
+                    if depth < len(tokens.layers) and tokens.layers[depth] is layer: break
+            active.pop()
+            self.stack = self.stack[:-1]
+            self.depth[name] -= 1
+            if self.depth[name] == 0: # recursive expansions are timed once
+                self.stats[name][3] += now - start
+    def rows(self, key=2):
+        # (name, expansions, tokens, self, cumulative, max argument), by
+        # decreasing value of field `key` of the stats.
+        return sorted(((name,) + tuple(stats) for name, stats in self.stats.items()),
+                      key=lambda row: row[key + 1], reverse=True)
+    def report(self, out=sys.stderr, limit=None, key=2):
+        out.write('%10s %10s %10s %10s %8s  %s\n' % ('expansions', 'tokens', 'self', 'cumulative', 'max arg', 'name'))
+        for (name, count, tokens, own, total, arg) in self.rows(key)[:limit]:
+            out.write('%10d %10d %10.4f %10.4f %8d  %s\n' % (count, tokens, own, total, arg, name))
+    def dump_collapsed(self, out):
+        # One line for every stack, with its frames separated by ';' and its
+        # time in microseconds or its number of samples.
+        for stack, value in sorted(self.flames.items()):
+            if self.stacks == 'exact':
+                value = int(round(value * 1e6))
+            if value > 0:
+                out.write('%s %d\n' % (';'.join(name.replace(';', ':') for name in stack), value))
+    def dump_json(self, out):
+        import json
+        fields = ('expansions', 'tokens', 'self', 'cumulative', 'max_argument')
+        json.dump({name: dict(zip(fields, stats)) for name, stats in self.stats.items()}, out, indent=1)
+    def dump_stats(self, filename):
+        # Writes the stats in the format of pstats, with the names as
+        # functions of a file called texp.
+        import marshal
+        stats = {}
+        for (name, count, tokens, own, total, arg) in self.rows():
+            stats[('texp', 0, name)] = (max(count, 1), max(count, 1), own, total, {})
+        with open(filename, 'wb') as handle:
+            marshal.dump(stats, handle)
+
+class Metrics():
+    # Counters of the work done by a TeX, cheap enough to be left on: how
+    # often each rule fired and how often it was tried and did not apply,
+    # the number of tokens tokenized, made by expansions and output, the
+    # largest number of pending tokens, depth of \input files and of groups
+    # seen, and the calls to populate() made by the lookahead views.  With a
+    # `callback`, it is called with a snapshot every `every` steps.
+    #
+    # Like Profiler, enable() replaces methods of the TeX and disable() puts
+    # them back.
+    class Table(dict):
+        # Maps a dispatch key to (rules, counts, checks), where counts[k] is
+        # the number of calls in which rule k fired, counts[-1] the number of
+        # calls in which none did and checks[k] is called after k fires.
+        def __init__(self, dispatch, checks):
+            self.dispatch = dispatch
+            self.checks = checks
+        def __missing__(self, key):
+            rules = self.dispatch[key]
+            entry = self[key] = (rules, [0] * (len(rules) + 1), [self.checks.get(r) for r in rules])
+            return entry
+
+    def __init__(self, t, callback=None, every=100000):
+        self.t = t
+        self.callback = callback
+        self.every = every
+        self.category = {}
+        for name in ('tokenizer', 'expander', 'command'):
+            for rule in type(t).__rules__[name]:
+                self.category[rule] = name
+        # Only the rules that can add pending tokens, open files or open
+        # groups are followed by a look at the high-water marks.
+        checks = {TeX.tokenizer_scan_line: self.scanned}
+        for rule in type(t).__rules__['expander']:
+            checks[rule] = self.expanded
+        # the token it pushes back was not made by an expansion
+        checks[TeX.expand_expandafter] = self.pending
+        for rule in (TeX.command_command, TeX.command_open_group, TeX.command_input_ended):
+            checks[rule] = self.changed
+        self.tables = dict((name, self.Table(dispatch, checks)) for name, dispatch in t.dispatch.items())
+        self.tokenized = 0
+        self.expanded_tokens = 0
+        self.max_tokens = 0
+        self.max_inputs = 0
+        self.max_groups = 0
+        self.populated = [0, 0]
+        self.views = None
+        self.steps = 0
+    def enable(self):
+        t = self.t
+        t.step_rules = self.step_rules
+        if self.callback is not None:
+            self.step = t.step
+            t.step = self.step_with_callback
+        self.views = ((t.autotokens, t.autotokens.populate), (t.autoexpandtokens, t.autoexpandtokens.populate))
+        for i, (view, populate) in enumerate(self.views):
+            view.populate = self.counted(populate, i)
+    def disable(self):
+        del self.t.step_rules
+        if self.callback is not None:
+            self.t.step = self.step
+        for view, populate in self.views:
+            view.populate = populate
+    def counted(self, populate, i):
+        populated = self.populated
+        def count():
+            populated[i] += 1
+            return populate()
+        return count
+    def step_rules(self, name):
+        t = self.t
+        (rules, counts, checks) = self.tables[name][t.dispatch_key()]
+        k = 0
+        for rule in rules:
+            if rule(t):
+                counts[k] += 1
+                if checks[k] is not None:
+                    checks[k]()
+                return True
+            k += 1
+        counts[k] += 1
+        return False
+    def step_with_callback(self):
+        self.steps += 1
+        if self.steps % self.every == 0:
+            self.callback(self.snapshot())
+        return self.step()
+    def scanned(self):
+        self.tokenized += self.t.scan_mark[5]
+        self.pending()
+    def expanded(self):
+        # An expansion pushes its tokens as a layer, which is then the only
+        # layer that has not been read from, see InputStack.
+        layers = self.t.tokens.layers
+        if layers and layers[-1][1] == 0:
+            self.expanded_tokens += len(layers[-1][0])
+        self.pending()
+    def pending(self):
+        n = len(self.t.tokens)
+        if n > self.max_tokens: self.max_tokens = n
+    def changed(self):
+        t = self.t
+        self.pending()
+        n = len(t.token_state)
+        if n > self.max_inputs: self.max_inputs = n
+        n = t.definitions.depth()
+        if n > self.max_groups: self.max_groups = n
+    def snapshot(self):
+        rules = {'tokenizer': {}, 'expander': {}, 'command': {}}
+        steps = 0
+        for name, table in self.tables.items():
+            for (rs, counts, _) in table.values():
+                if name == 'step':
+                    steps += sum(counts[:-1])
+                reached = sum(counts)
+                for rule, fired in zip(rs, counts):
+                    stats = rules[self.category[rule]].setdefault(rule.__name__, {'fired': 0, 'failed': 0})
+                    stats['fired'] += fired
+                    stats['failed'] += reached - fired
+                    reached -= fired
+        return {
+            'steps': steps,
+            'rules': rules,
+            'tokens': {'tokenized': self.tokenized,
+                       'expanded': self.expanded_tokens,
+                       'output': rules['command'].get('command_token', {'fired': 0})['fired']},
+            'high_water': {'tokens': self.max_tokens, 'inputs': self.max_inputs, 'groups': self.max_groups},
+            'populate': {'tokens': self.populated[0], 'expanded_tokens': self.populated[1]},
+        }
 
 class InvalidCharacter(BaseException): pass
 
 class TeXError(BaseException): pass
 
-
-def exists(pred, iter):
-    for x in iter:
-        if pred(x):
-            return True
-    return False
+class LimitExceeded(TeXError):
+    # Raised when a TeX goes over one of its limits, see TeX.Limits.
+    # `limit` is the name of the limit and `value` what it was set to.
+    def __init__(self, message, limit=None, value=None):
+        super().__init__(message)
+        self.limit = limit
+        self.value = value
+
+
+token_table = {}
+
+def token(name, cat):
+    # Tokens are (name, category) pairs.  Every distinct token is made once
+    # and shared, so token lists are small and compare tokens by identity.
+    # The table is never emptied, so it only has the tokens of characters
+    # and of the names the code uses; the control sequences of a document
+    # are shared in TeX.cs_tokens, which goes away with the TeX.
+    t = (name, cat)
+    return token_table.setdefault(t, t)
+
+def applies_to(*keys):
+    # Marks a rule as applying only when TeX.dispatch_key is one of `keys`.
+    # Rules that are not marked are tried for every key.
+    def mark(rule):
+        rule.keys = keys
+        return rule
+    return mark
 
 def recursive_descent_matcher(rules, start, index, tokens):
     def iseof(tokens, idx):
@@ -86,8 +820,37 @@ class TeX():
 
     __commands__ = {}
 
+    class Dispatch(dict):
+        # Maps a dispatch key to the rules that may apply to it, in the order
+        # they were registered.
+        def __init__(self, rules):
+            self.rules = rules
+        def __missing__(self, key):
+            rules = self[key] = tuple(r for r in self.rules if key in getattr(r, 'keys', (key,)))
+            return rules
+
+    def dispatch_key(self):
+        # The category of the first pending token and, for control sequences
+        # and active characters, the kind of its definition.
+        if len(self.tokens) == 0:
+            return None
+        (name, cat) = self.tokens[0]
+        if cat == self.control_sequence:
+            defn = self.definitions.get(name)
+            if isinstance(defn, self.Functional):
+                return (cat, 'macro')
+            if isinstance(defn, self.Builtin):
+                return (cat, defn.type)
+            if defn is None and not name in self.definitions:
+                return (cat, 'undefined')
+            return (cat, None)
+        if cat == self.active:
+            if isinstance(self.definitions.get((name,)), self.Functional):
+                return (cat, 'macro')
+        return (cat, None)
+
     def step_rules(self, name):
-        for i in self.__rules__[name]:
+        for i in self.dispatch[name][self.dispatch_key()]:
             if i(self):
                 # print(i)
                 return True
@@ -103,24 +866,117 @@ class TeX():
         return self.step_rules('command')
 
     def step(self):
-        return self.step_rules('command') or self.step_rules('expander') or self.step_rules('tokenizer')
+        return self.step_rules('step')
 
     def accepting_state(self):
-        return self.tokens == [] and self.input == '' and self.line == ''
+        return len(self.tokens) == 0 and self.input.at_end(self.input_pos) and self.line == ''
+
+    def process(self):
+        try:
+            self.process_steps()
+        finally:
+            self.output.flush()
+            if self.token_cache is not None:
+                self.token_cache.save()
+
+    def process_steps(self, count=math.inf):
+        # Takes up to `count` steps, fewer if no rule applies, and returns
+        # the number of steps taken.
+        n = 0
+        if self.limits is None:
+            while n < count and self.step():
+                n += 1
+            self.steps += n
+            return n
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.bounds[4]
+        while n < count and self.step():
+            n += 1
+            self.steps += 1
+            self.check_bounds()
+        return n
+
+    def check_bounds(self):
+        # Called after every step and, as a step may expand without end
+        # (in \csname or while a number or file name is read), after every
+        # macro expansion and lookahead when there are limits.
+        (steps, depth, size, inputs, seconds) = self.bounds
+        tokens = self.tokens
+        if (self.steps > steps or len(tokens) > size or len(tokens.layers) > depth or len(self.token_state) > inputs
+            or (self.steps & 1023 == 0 and self.deadline is not None and time.monotonic() > self.deadline)):
+            self.check_limits()
+
+    def check_limits(self):
+        (steps, depth, size, inputs, seconds) = self.limits
+        if steps is not None and self.steps > steps:
+            exceeded = ('steps', steps, 'Step limit of %d exceeded' % steps)
+        elif depth is not None and len(self.tokens.layers) > depth:
+            exceeded = ('depth', depth, 'Expansion depth limit of %d exceeded' % depth)
+        elif size is not None and len(self.tokens) > size:
+            exceeded = ('tokens', size, 'Limit of %d pending tokens exceeded' % size)
+        elif inputs is not None and len(self.token_state) > inputs:
+            exceeded = ('inputs', inputs, 'Limit of %d nested \\input files exceeded' % inputs)
+        elif seconds is not None and self.deadline is not None and time.monotonic() > self.deadline:
+            exceeded = ('seconds', seconds, 'Time limit of %gs exceeded' % seconds)
+        else:
+            return
+        (limit, value, message) = exceeded
+        toks = ''.join([x for x, c in self.tokens[0:40]])
+        raise LimitExceeded('%s after %d steps and expansions on line %d of file %s, %d tokens pending, %d expansions deep:\n    "%s ..."'
+                            % (message, self.steps, self.line_num, self.file or '<input>', len(self.tokens),
+                               len(self.tokens.layers), toks), limit, value)
+
+    def feed(self, text):
+        # Appends `text` to the input stream and processes as much of the
+        # input as can be without knowing what follows it.  Text fed after
+        # the stream has been left by \endinput is ignored.
+        if self.stream is None:
+            raise TeXError("Input can only be fed to a TeX reading a StreamSource")
+        if self.stream is (self.token_state[0][3] if self.token_state else self.input):
+            self.stream.feed(text)
+            self.process()
+
+    def close(self):
+        # Ends the input stream and processes the rest of the input.
+        if self.stream is None:
+            raise TeXError("Input can only be fed to a TeX reading a StreamSource")
+        self.stream.close()
+        self.process()
+
+    def iter_output(self, chunks):
+        # Feeds each string of `chunks`, an iterable or a text file, to the
+        # input stream, closes it and yields the output as it is produced.
+        # What could not be processed is reported by diagnostic().
+        if not hasattr(chunks, '__iter__'):
+            chunks = iter(lambda: chunks.read(65536), '')
+        produced = []
+        target, self.output.target = self.output.target, produced.append
+        try:
+            for chunk in chunks:
+                self.feed(chunk)
+                ready, produced[:] = produced[:], []
+                yield from ready
+            self.close()
+            yield from produced
+        finally:
+            self.output.target = target
 
     def run(self):
-        while self.step():
-            # self.print_state()
-            pass
-        if not self.accepting_state():
-            print ("Got stuck while processing the following input on line", self.line_num)
-            size = 75
-            toks = ''.join([x for x, c in self.tokens[0:size]])
-            l = self.line[0:size - len(toks)]
-            i = self.input[0:size - len(toks) - len(l)]
-            print('    "' + toks + l + i, '..."')
-            # print(self.tokens[0:20])
-            pass
+        self.process()
+        message = self.diagnostic()
+        if message is not None:
+            print(message)
+
+    def diagnostic(self):
+        # Describes the input that could not be processed, if there is any.
+        if self.accepting_state():
+            return None
+        size = 75
+        toks = ''.join([x for x, c in self.tokens[0:size]])
+        l = (self.skipped + self.line[self.line_pos:])[:size - len(toks)]
+        i = self.input.peek(self.input_pos, size - len(toks) - len(l))
+        # print(self.tokens[0:20])
+        return 'Got stuck while processing the following input on line %d\n    "%s ..."' % (self.line_num, toks + l + i)
 
 
     # Character category codes
@@ -146,18 +1002,54 @@ class TeX():
     macro = -3
     parameter = -4
 
-    class CatcodeMapStack(MapStack):
-        def __getitem__(self, key):
-            try:
-                return super().__getitem__(key)
-            except KeyError:
-                cc = TeX.default_catcode(key)
-                if cc < 0:
-                    raise KeyError
+    class CatcodeTable():
+        # Category codes of Latin-1 characters are kept in a byte array and
+        # assignments to other characters in a dict.  Inside a group the
+        # previous values are recorded in an undo log that pop() replays, so
+        # a lookup does not depend on how deeply groups are nested.
+        latin1_defaults = None
+
+        def __init__(self):
+            if self.latin1_defaults is None:
+                TeX.CatcodeTable.latin1_defaults = bytes(TeX.default_catcode(chr(i)) for i in range(256))
+            self.latin1 = bytearray(self.latin1_defaults)
+            self.other = {}
+            self.undo = []
+            self.version = 0
+        def __getitem__(self, char):
+            if len(char) == 1 and ord(char) < 256:
+                return self.latin1[ord(char)]
+            cc = self.other.get(char)
+            if cc is None:
+                return TeX.default_catcode(char)
+            return cc
+        def __contains__(self, char):
+            return True
+        def __setitem__(self, char, cc):
+            if self.undo:
+                self.undo[-1].append( (char, self[char]) )
+            if len(char) == 1 and ord(char) < 256:
+                self.latin1[ord(char)] = cc
+            else:
+                self.other[char] = cc
+            self.version += 1
+        def push(self):
+            self.undo.append([])
+        def pop(self):
+            for char, cc in reversed(self.undo.pop()):
+                if len(char) == 1 and ord(char) < 256:
+                    self.latin1[ord(char)] = cc
                 else:
-                    return cc
-        def __contains__(self, key):
-            return (super().__contains__(key)) or (TeX.default_catcode(key) >= 0)
+                    self.other[char] = cc
+            self.version += 1
+        def fingerprint(self):
+            other = sorted(self.other.items())
+            return hashlib.sha1(bytes(self.latin1) + repr(other).encode('utf-8')).hexdigest()
+        def items(self):
+            # characters whose category code may differ from the default
+            for i, cc in enumerate(self.latin1):
+                yield chr(i), cc
+            yield from self.other.items()
 
     class T():
         def __init__(self, size, get, populate):
@@ -178,7 +1070,211 @@ class TeX():
                     # raise IndexError
             return self.get(idx)
 
-    Functional = namedtuple('Functional', ['params', 'body'])
+    class Definitions(MapStack):
+        # Counts the changes to names bound to conditionals, \else and \fi,
+        # so that skipping can cache the names, see TeX.skip_names.
+        def __init__(self):
+            super().__init__()
+            self.skip_version = 0
+        def affects_skipping(self, value):
+            return isinstance(value, TeX.Builtin) and value.type in TeX.skip_types
+        def __setitem__(self, name, value):
+            if self.affects_skipping(value) or self.affects_skipping(self.get(name)):
+                self.skip_version += 1
+            super().__setitem__(name, value)
+        def pop(self):
+            for name, value in self.saved[-1].items():
+                if self.affects_skipping(value) or self.affects_skipping(self.get(name)):
+                    self.skip_version += 1
+                    break
+            super().pop()
+
+    class Scanner():
+        # Tokenizes a line in one pass with the category codes in effect when
+        # the scanner was made; TeX makes a new one after every \catcode.
+        # Runs of letters and others are found with a regular expression
+        # compiled from the category code table.
+        class Chars(dict):
+            # maps a character to its token
+            def __init__(self, catcode):
+                self.catcode = catcode
+            def __missing__(self, char):
+                t = self[char] = token(char, self.catcode[char])
+                return t
+
+        def __init__(self, catcode, cs_tokens):
+            self.chars = self.Chars(catcode)
+            self.cs_tokens = cs_tokens
+            self.version = catcode.version
+            specials = []
+            spaces = []
+            stops = []
+            for c, cc in catcode.items():
+                if cc not in (TeX.letter, TeX.other):
+                    specials.append(c)
+                elif c.isspace():
+                    spaces.append(c)
+                if cc in (TeX.escape, TeX.end_of_line, TeX.comment, TeX.invalid):
+                    stops.append(c)
+            run = '[^%s\\s]' % ''.join(re.escape(c) for c in specials)
+            if spaces:
+                run = '(?:%s|[%s])' % (run, ''.join(re.escape(c) for c in spaces))
+            self.run = re.compile(run + '+').match
+            # characters that matter when input is skipped, see skip
+            self.stop = re.compile('[%s]' % ''.join(re.escape(c) for c in stops) if stops else '(?!)').search
+
+        def scan(self, line, pos, state, limit=-1):
+            # Returns the tokens of `line[pos:]` together with the position and
+            # state the scan ended in.  Scanning stops before an invalid
+            # character and after `limit` tokens.
+            chars = self.chars
+            toks = []
+            n = len(line)
+            while pos < n and len(toks) != limit:
+                t = chars[line[pos]]
+                cc = t[1]
+                if cc == TeX.letter or cc == TeX.other:
+                    run = self.run(line, pos).group()
+                    if limit >= 0: run = run[:limit - len(toks)]
+                    toks.extend(map(chars.__getitem__, run))
+                    pos += len(run)
+                    state = TeX.middle
+                elif cc == TeX.escape:
+                    j = pos + 1
+                    while j < n and chars[line[j]][1] == TeX.letter:
+                        j += 1
+                    if j == pos + 1: j = pos + 2
+                    cs = (line[pos+1:j], TeX.control_sequence)
+                    toks.append(self.cs_tokens.setdefault(cs, cs))
+                    pos = min(j, n)
+                    state = TeX.skipping
+                elif cc == TeX.space:
+                    if state == TeX.middle:
+                        toks.append(TeX.space_token)
+                        state = TeX.skipping
+                    pos += 1
+                elif cc == TeX.end_of_line:
+                    if state == TeX.new_line:
+                        toks.append(TeX.par_token)
+                    elif state == TeX.middle:
+                        toks.append(TeX.space_token)
+                        state = TeX.new_line
+                    pos = n
+                elif cc == TeX.comment:
+                    pos = n
+                elif cc == TeX.ignored:
+                    pos += 1
+                elif cc == TeX.invalid:
+                    break
+                else:
+                    toks.append(t)
+                    pos += 1
+                    state = TeX.middle
+            return toks, pos, state
+
+        def skip(self, line, pos, names):
+            # Finds the first control sequence in `names` without making tokens
+            # for the text before it.  Returns its token and the position after
+            # it, None and the end of the line if there is none, or None and
+            # the position of an invalid character.
+            chars = self.chars
+            n = len(line)
+            while True:
+                m = self.stop(line, pos)
+                if m is None:
+                    return None, n
+                pos = m.start()
+                cc = chars[line[pos]][1]
+                if cc == TeX.invalid:
+                    return None, pos
+                if cc != TeX.escape:
+                    return None, n
+                j = pos + 1
+                while j < n and chars[line[j]][1] == TeX.letter:
+                    j += 1
+                if j == pos + 1: j = pos + 2
+                if line[pos+1:j] in names:
+                    cs = (line[pos+1:j], TeX.control_sequence)
+                    return self.cs_tokens.setdefault(cs, cs), min(j, n)
+                pos = min(j, n)
+
+    class Template():
+        # A macro prepared for expansion: the tokens that have to follow the
+        # macro name, the delimiter of every parameter (None if it is not
+        # delimited) and the body split at the parameter references.
+        memo_failures = 0 # see ExpansionCache.hopeless
+        def __init__(self, params, body):
+            i = 0
+            while i < len(params) and params[i][1] != TeX.parameter:
+                i += 1
+            self.prefix = params[:i]
+            self.delimiters = []
+            while i < len(params):
+                j = i + 1
+                while j < len(params) and params[j][1] != TeX.parameter:
+                    j += 1
+                self.delimiters.append(self.delimiter(params[i+1:j]))
+                i = j
+            self.parts = []
+            literal = []
+            for t in body:
+                if t[1] == TeX.parameter:
+                    self.parts.append( (literal, int(t[0]) - 1) )
+                    literal = []
+                else:
+                    literal.append(t)
+            self.tail = literal
+            self.body = body
+
+        @staticmethod
+        def delimiter(tokens):
+            # A delimiter together with its KMP failure function: fail[q] is
+            # the length of the longest proper prefix of tokens[:q+1] that is
+            # also its suffix.
+            if len(tokens) == 0:
+                return None
+            fail = [0] * len(tokens)
+            k = 0
+            for q in range(1, len(tokens)):
+                while k > 0 and tokens[q] != tokens[k]:
+                    k = fail[k-1]
+                if tokens[q] == tokens[k]:
+                    k += 1
+                fail[q] = k
+            return (tokens, fail)
+
+        def dump(self):
+            return (self.prefix, self.delimiters, self.parts, self.tail)
+
+        @classmethod
+        def load(cls, body, state, intern):
+            # The inverse of dump; `intern` is applied to every token list.
+            (prefix, delimiters, parts, tail) = state
+            self = cls.__new__(cls)
+            self.prefix = intern(prefix)
+            self.delimiters = [d and (intern(d[0]), d[1]) for d in delimiters]
+            self.parts = [(intern(literal), n) for literal, n in parts]
+            self.tail = intern(tail)
+            self.body = body
+            return self
+
+        def expand(self, args):
+            if not self.parts:
+                # definitions are never modified, the body can be read in place
+                return self.body
+            expansion = []
+            for literal, n in self.parts:
+                expansion += literal
+                expansion += args[n]
+            expansion += self.tail
+            return expansion
+
+    class Functional(namedtuple('Functional', ['params', 'body'])):
+        # A macro, compiled into a Template when it is defined.
+        def __new__(cls, params, body, template=None):
+            self = super().__new__(cls, params, body)
+            self.template = template or TeX.Template(params, body)
+            return self
     Builtin = namedtuple('Builtin', ['type'])
 
 
@@ -205,42 +1301,77 @@ class TeX():
     skipping = 1
     middle = 2
 
-    def __init__(self, inp=''):
+    space_token = token(' ', space)
+    par_token = token('par', control_sequence)
+
+    def __init__(self, inp='', output=None, fmt=None, token_cache=None, limits=None, expansion_cache=None):
+        self.output = OutputSink(output)
         self.state = self.new_line
-        self.catcode = self.CatcodeMapStack()
-        self.definitions = MapStack()
-        self.tokens = []
+        self.catcode = self.CatcodeTable()
+        self.definitions = self.Definitions()
+        self.skip_cache = None
+        self.skipped = ''
+        self.tokens = InputStack()
         self.line = ''
+        self.line_pos = 0
+        self.scanner = None
+        # the tokens of control sequences, see token
+        self.cs_tokens = {}
+        self.scan_mark = None
+        self.token_cache = token_cache
+        self.limits = limits
+        if limits is not None:
+            self.bounds = [math.inf if x is None else x for x in limits]
+        self.expansion_cache = expansion_cache
+        self.expand_once = False
+        self.steps = 0
+        self.deadline = None
+        self.line_cache = None
+        if isinstance(inp, str):
+            inp = StringSource(inp)
         self.input = inp
+        self.stream = inp if isinstance(inp, StreamSource) else None
+        self.input_pos = 0
         self.condition_level = 0
-        self.populate_with_default_macros()
 
         self.line_num = 0
         self.file = ''
 
         self.token_state = []
 
+        self.dispatch = {}
+        for name, rules in self.__rules__.items():
+            self.dispatch[name] = self.Dispatch(rules)
+        self.dispatch['step'] = self.Dispatch(self.__rules__['command'] + self.__rules__['expander'] + self.__rules__['tokenizer'])
+
         def size(): return len(self.tokens)
         def get(idx): return self.tokens[idx]
-        def populate(): return self.tokenize() # self.step_rules('tokenizer')
+        def populate():
+            if self.limits is not None:
+                self.check_bounds()
+            return self.tokenize() # self.step_rules('tokenizer')
         self.autotokens = self.T(size, get, populate)
 
-        self.expanded_tokens = []
+        self.expanded_tokens = TokenQueue()
         self.noexpand_followed_by = None
         self.no_expand = False
         def esize(): return len(self.expanded_tokens)
         def eget(idx): return self.expanded_tokens[idx]
         def epopulate():
+            if self.limits is not None:
+                self.check_bounds()
             while True:
                 t = self.autotokens[0]
                 if t[1] == self.control_sequence and not self.no_expand:
                     if t[0] in self.definitions:
-                        self.expand()
+                        if not self.expand():
+                            raise IndexError("Arguments of `%s' not available" % t[0])
                     else:
                         raise TeXError("Undefined macro encountered `%s'" % t[0])
                 elif t[1] == self.active:
                     if (t[0],) in self.definitions:
-                        self.expand()
+                        if not self.expand():
+                            raise IndexError("Arguments of `%s' not available" % t[0])
                     else:
                         raise TeXError("Undefined active character encountered `%s'" % t[0])
                 else:
@@ -249,31 +1380,41 @@ class TeX():
                     else:
                         self.no_expand = False
                     self.expanded_tokens.append(t)
-                    self.tokens = self.tokens[1:]
+                    self.tokens.drop(1)
                     # print(self.expanded_tokens)
                     break
         self.autoexpandtokens = self.T(esize, eget, epopulate)
 
+        if isinstance(fmt, TeX.Snapshot):
+            self.restore(fmt)
+        elif fmt is not None:
+            if isinstance(fmt, str):
+                with open(fmt, 'rb') as handle:
+                    fmt = handle.read()
+            self.load_format(fmt)
+        else:
+            self.populate_with_default_macros()
+
         # Define user macros
         self.define_macros()
 
     def populate_with_default_macros(self):
-        self.definitions['def'] = self.Functional([], [('def', self.command)])
-        self.definitions['let'] = self.Functional([], [('let', self.command)])
+        self.definitions['def'] = self.Functional([], [token('def', self.command)])
+        self.definitions['let'] = self.Functional([], [token('let', self.command)])
         # self.definitions['def'] = ([], [('def', self.command)])
-        self.definitions['par'] = self.Functional([], [('par', self.command)])
-        self.definitions['char'] = self.Functional([], [('char', self.command)])
-        self.definitions['catcode'] = self.Functional([], [('catcode', self.command)])
+        self.definitions['par'] = self.Functional([], [token('par', self.command)])
+        self.definitions['char'] = self.Functional([], [token('char', self.command)])
+        self.definitions['catcode'] = self.Functional([], [token('catcode', self.command)])
         self.definitions['relax'] = self.Builtin('relax')
-        self.definitions[' '] = self.Functional([], [(' ', self.space)])
-        for c in '%#@!`~${}^&*': self.definitions[c] = self.Functional([], [(c, self.other)])
+        self.definitions[' '] = self.Functional([], [self.space_token])
+        for c in '%#@!`~${}^&*': self.definitions[c] = self.Functional([], [token(c, self.other)])
 
         # TODO: { } and \begin and \endgroup should not mix
         # self.definitions['begingroup'] = self.Functional([], [('{', self.begin_group)])
         # self.definitions['endgroup'] = self.Functional([], [('{', self.end_group)])
 
-        self.definitions['input'] = self.Functional([], [('input', self.command)])
-        self.definitions['endinput'] = self.Functional([], [('endinput', self.command)])
+        self.definitions['input'] = self.Functional([], [token('input', self.command)])
+        self.definitions['endinput'] = self.Functional([], [token('endinput', self.command)])
 
         self.definitions['ifx'] = self.Builtin('ifx')
         self.definitions['iftrue'] = self.Builtin('iftrue')
@@ -288,123 +1429,163 @@ class TeX():
 
         self.definitions['expandafter'] = self.Builtin('expandafter')
 
+    format_header = b'texp format 1\n'
+
+    def dump_format(self):
+        # Returns the definitions and category codes as the contents of a
+        # format file, which a TeX made with fmt= starts from.
+        if self.definitions.depth() > 0:
+            raise TeXError("A format can not be dumped inside a group")
+        defs = {}
+        for name, defn in self.definitions.items():
+            if isinstance(defn, self.Functional):
+                defs[name] = ('macro', defn.params, defn.body, defn.template.dump())
+            elif isinstance(defn, self.Builtin):
+                defs[name] = ('builtin', defn.type)
+            else:
+                defs[name] = None
+        state = (defs, bytes(self.catcode.latin1), self.catcode.other)
+        return self.format_header + pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+    def load_format(self, data):
+        if not data.startswith(self.format_header):
+            raise TeXError("Not a texp format file")
+        (defs, latin1, other) = pickle.loads(memoryview(data)[len(self.format_header):])
+        def intern(toks):
+            return [self.cs_tokens.setdefault(t, t) if t[1] == self.control_sequence else token(*t) for t in toks]
+        definitions = {}
+        for name, defn in defs.items():
+            if defn is None:
+                definitions[name] = None
+            elif defn[0] == 'builtin':
+                definitions[name] = self.Builtin(defn[1])
+            else:
+                (_, params, body, template) = defn
+                body = intern(body)
+                definitions[name] = self.Functional(intern(params), body, self.Template.load(body, template, intern))
+        self.definitions.thaw(None)
+        self.definitions.map = definitions
+        self.definitions.skip_version += 1
+        self.catcode.latin1 = bytearray(latin1)
+        self.catcode.other = dict(other)
+        self.catcode.undo = []
+        self.catcode.version += 1
+
+    # Bounds on the work a TeX may do, None for no bound: the number of
+    # steps and macro expansions, the depth of the expansions being read, the number of pending
+    # tokens, the depth of \input files and the seconds from the start of
+    # processing.  LimitExceeded is raised when one is exceeded.
+    Limits = namedtuple('Limits', ['steps', 'depth', 'tokens', 'inputs', 'seconds'], defaults=(None,) * 5)
+
+    Snapshot = namedtuple('Snapshot', ['definitions', 'latin1', 'other', 'condition_level'])
+
+    def snapshot(self):
+        # Takes the definitions, category codes and conditional level, which
+        # restore() or TeX(fmt=snapshot) start from.  The definitions are
+        # frozen and shared rather than copied, so this takes constant time
+        # and later changes on either side only cost the names they change.
+        if self.definitions.depth() > 0:
+            raise TeXError("A snapshot can not be taken inside a group")
+        return self.Snapshot(self.definitions.freeze(), bytes(self.catcode.latin1),
+                             dict(self.catcode.other), self.condition_level)
+
+    def restore(self, snapshot):
+        # Unlike the definitions, the input is not part of a snapshot.
+        self.definitions.thaw(snapshot.definitions)
+        self.definitions.skip_version += 1
+        self.catcode.latin1 = bytearray(snapshot.latin1)
+        self.catcode.other = dict(snapshot.other)
+        self.catcode.undo = []
+        self.catcode.version += 1
+        self.condition_level = snapshot.condition_level
+
+    def fork(self, inp='', output=None):
+        # A new TeX of the same class reading `inp` with the current definitions.
+        return type(self)(inp, output, fmt=self.snapshot())
+
     def print_state(self):
         print()
         print('State:', self.state)
         print('Tokens:', str(self.tokens))
-        print('Line:', self.line[0:20], '...')
-        print('Input:', self.input[0:20], '...')
+        print('Line:', self.line[self.line_pos:self.line_pos + 20], '...')
+        print('Input:', self.input.peek(self.input_pos, 20), '...')
 
     def tokenizer_read_line(self):
-        if self.line == '' and len(self.input) > 0:
-            i = self.input.find('\n')
-            if i >= 0:
-                k = i
-                for j in range(i - 1, -1, -1):
-                    if not (self.input[j] == ' '):
-                        k = j + 1
-                        break
-                self.line = self.input[0:k] + '\n'
-                self.input = self.input[i+1:]
-            else:
-                self.line = self.input
-                self.input = ''
+        if self.line == '' and not self.input.at_end(self.input_pos):
+            line, self.input_pos = self.input.readline(self.input_pos)
+            if line.endswith('\n'):
+                line = line[:-1].rstrip(' ') + '\n'
+            self.line = line
+            self.line_pos = 0
             self.state = self.new_line
             self.line_num += 1
+            # the previous line has been read in full
+            self.scan_mark = None
             return True
         return False
 
     __rules__['tokenizer'].append(tokenizer_read_line)
 
-
-    def tokenize_control_code(self):
-        # if len(self.line) > 0: print (self.line[0])
-        if len(self.line) > 0 and self.catcode[self.line[0]] == self.escape:
-            k = 1
-            for i in range(1, len(self.line)):
-                if self.catcode[self.line[i]] != self.letter:
-                    break 
-                k = i
-            self.tokens.append( (self.line[1:k+1], self.control_sequence) )
-            self.line = self.line[k+1:]
-            self.state = self.skipping
-            return True
-        return False
-
-    __rules__['tokenizer'].append(tokenize_control_code)
-
-    def tokenizer_scan_char(self):
-        if len(self.line) > 0 and self.catcode[self.line[0]] in (1, 2, 3, 4, 6, 7, 8, 11, 12, 13):
-            self.state = self.middle
-            self.tokens.append( (self.line[0], self.catcode[self.line[0]]) )
-            self.line = self.line[1:]
-            return True
-        return False
-
-    __rules__['tokenizer'].append(tokenizer_scan_char)
-
-    def tokenizer_scan_space(self):
-        if len(self.line) > 0 and self.catcode[self.line[0]] == self.space:
-            if self.state == self.middle:
-                self.tokens.append( (' ', self.space) )
-                self.state = self.skipping
-            self.line = self.line[1:]
-            return True
-        return False
-
-    __rules__['tokenizer'].append(tokenizer_scan_space)
-
-    def tokenizer_scan_newline(self):
-        if len(self.line) > 0 and self.catcode[self.line[0]] == self.end_of_line:
-            if self.state == self.new_line:
-                self.tokens.append( ('par', self.control_sequence) )
-            elif self.state == self.middle:
-                self.tokens.append( (' ', self.space) )
-                self.state = self.new_line
-            self.line = ''
-            return True
-        return False
-
-    __rules__['tokenizer'].append(tokenizer_scan_newline)
-
-    def tokenizer_scan_ignore(self):
-        if len(self.line) > 0 and self.catcode[self.line[0]] == self.ignored:
-            self.line = self.line[1:]
-            return True
-        return False
-
-    __rules__['tokenizer'].append(tokenizer_scan_ignore)
-
-    def tokenizer_scan_invalid(self):
-        if len(self.line) > 0 and self.catcode[self.line[0]] == self.invalid:
-            self.line = self.line[1:]
-            raise InvalidCharacter()
-            # return True
-        return False
-
-    __rules__['tokenizer'].append(tokenizer_scan_invalid)
-
-    def tokenizer_scan_comment(self):
-        if len(self.line) > 0 and self.catcode[self.line[0]] == self.comment:
-            self.line = ''
+    def tokenizer_scan_line(self):
+        if self.line != '':
+            if self.scanner is None or self.scanner.version != self.catcode.version:
+                self.scanner = self.Scanner(self.catcode, self.cs_tokens)
+            line, pos, state = self.line, self.line_pos, self.state
+            cache = self.line_cache
+            if cache is not None and (pos != 0 or state != self.new_line or cache[1] != self.catcode.version):
+                cache = None
+            hit = cache and cache[0].get(self.line_num)
+            if hit is not None:
+                toks, self.state = hit
+                self.line = ''
+            else:
+                toks, self.line_pos, self.state = self.scanner.scan(line, pos, state)
+                invalid = self.line_pos == pos
+                if invalid: self.line_pos += 1
+                if self.line_pos >= len(line):
+                    self.line = ''
+                    self.line_pos = 0
+                    if cache is not None and not invalid:
+                        self.token_cache.add(cache[2], self.line_num, toks, self.state)
+                if invalid: raise InvalidCharacter()
+            self.tokens.extend(toks)
+            # all but the first token may have been scanned ahead of time,
+            # remember how to scan them again, see retokenize
+            self.scan_mark = (self.tokens.bottom, line, pos, state, self.scanner, len(toks))
             return True
         return False
 
-    __rules__['tokenizer'].append(tokenizer_scan_comment)
-
+    __rules__['tokenizer'].append(tokenizer_scan_line)
+
+    def retokenize(self):
+        # Called after a category code change: tokens of the current line
+        # that were scanned ahead and are not read yet are scanned again.
+        mark, self.scan_mark = self.scan_mark, None
+        if mark is None: return
+        (queue, line, pos, state, scanner, count) = mark
+        k = min(len(queue), count)
+        if queue is not self.tokens.bottom or k == 0: return
+        _, pos, state = scanner.scan(line, pos, state, count - k)
+        queue.truncate(k)
+        self.line = line
+        self.line_pos = pos
+        self.state = state
+
+    @applies_to((command, None))
     def command_command(self):
         if len(self.tokens) > 0 and self.tokens[0][1] == self.command and self.tokens[0][0] in self.__commands__:
             cmd = self.__commands__[self.tokens[0][0]]
-            cmd(self)
-            return True
+            # a command returns False when the input does not match it yet
+            return cmd(self) is not False
         return False
 
     __rules__['command'].append(command_command)
 
+    @applies_to((command, None))
     def command_unknown_command(self):
         if len(self.tokens) > 0 and self.tokens[0][1] == self.command and not self.tokens[0][0] in self.__commands__:
             cmd = self.tokens[0][0]
-            self.tokens = self.tokens[1:]
+            self.tokens.drop(1)
             if not self.process_command(cmd):
                 raise TeXError("Unknown primitive `%s'" % cmd)
             return True
@@ -414,7 +1595,7 @@ class TeX():
 
 
     def command_def(self):
-        if len(self.tokens) > 0 and self.tokens[0] == ('def', self.command):
+        if len(self.tokens) > 0 and self.tokens[0] == token('def', self.command):
             ts  = self.autotokens
             c = None
             try:
@@ -452,7 +1633,7 @@ class TeX():
                 i = 0
                 while i < len(toks):
                     if i + 1 < len(toks) and toks[i][1] == self.param and toks[i+1][1] == self.other:
-                        n.append( (toks[i+1][0], self.parameter) )
+                        n.append(token(toks[i+1][0], self.parameter))
                         i = i + 2
                     else:
                         n.append( toks[i] )
@@ -472,13 +1653,14 @@ class TeX():
             if not set(bodyparam).issubset(set(seq)): raise TeXError()
 
             self.definitions[c] = self.Functional(params, body)
-            self.tokens = ts[b+1:]
+            self.tokens.drop(b+1)
             return True
         return False
 
     __commands__['def'] = command_def
 
 
+    @applies_to((control_sequence, 'undefined'))
     def expander_macro_not_defined(self):
         if len(self.tokens) > 0 and self.tokens[0][1] == self.control_sequence and not (self.tokens[0][0] in self.definitions):
             # print ("Definition not found", self.tokens[0][0])
@@ -487,118 +1669,201 @@ class TeX():
 
     __rules__['command'].append(expander_macro_not_defined)
 
+    @applies_to((control_sequence, 'macro'), (active, 'macro'))
     def expander_expand_macro(self):
-        if (len(self.tokens) > 0 
-            and ((self.tokens[0][1] == self.control_sequence 
-                 and self.tokens[0][0] in self.definitions
-                 and isinstance(self.definitions[self.tokens[0][0]], self.Functional))
-                 or
-                 (self.tokens[0][1] == self.active
-                 and (self.tokens[0][0],) in self.definitions
-                 and isinstance(self.definitions[(self.tokens[0][0],)], self.Functional)))
-            ):
-
-            t = self.tokens[0]
-            if t[1] == self.active:
-                res = (t[0],)
-            else:
-                res = t[0]
-
-            # (params, body) = self.definitions[self.tokens[0][0]]
-            (params, body) = self.definitions[res]
-            def next_token_or_group(ts, i):
-                g = 0
-                if ts[i][1] == self.begin_group:
-                    b = -1
-                    while True:
-                        if ts[i][1] == self.begin_group: g = g + 1
-                        elif  ts[i][1] == self.end_group: g = g - 1
-                        if g == 0: 
-                            b = i
-                            break
-                        i += 1
-                    return b
-                else:
-                    return i
-
-            def find(arr, i, f, notfound=-1):
-                for j in range(i, len(arr)):
-                    if f(arr[j]):
-                        return j
-                return notfound
-
-            p = 0
-            i = 1
-            matched = []
+        if len(self.tokens) == 0:
+            return False
+        t = self.tokens[0]
+        if t[1] == self.control_sequence:
+            defn = self.definitions.get(t[0])
+        elif t[1] == self.active:
+            defn = self.definitions.get((t[0],))
+        else:
+            return False
+        if isinstance(defn, self.Functional):
+            template = defn.template
             try:
-                while p < len(params):
-                    # if it is a non-delimeted parameter
-                    if params[p][1] == self.parameter and (p+1 == len(params) or params[p+1][1] == self.parameter):
-                        j = next_token_or_group(self.autotokens, i)
-                        # TODO: also possibly match optional spaces
-                        if j < 0: return False
-                        # print(j-i)
-                        if j - i > 0: # strip the group tokens
-                            matched.append(self.autotokens[i+1:j])
-                        else:
-                            matched.append(self.autotokens[i:j+1])
-                        i = j+1
-                        p = p+1
-                    # if it is a delimited parameter
-                    elif params[p][1] == self.parameter:
-                        k = find(params, p+1, lambda x: x[1] == self.parameter, len(params))
-                        tomatch = params[p+1:k]
-                        j = i
-                        m = False
-                        # while j < len(self.tokens):
-                        while True:
-                            if tomatch == self.autotokens[j:j+len(tomatch)]:
-                                m = True
-                                break
-                            j = next_token_or_group(self.tokens, j) + 1
-                        if not m: return False
-                        matched.append(self.tokens[i:j])
-                        i = j + len(tomatch)
-                        p = k
-                    else:
-                        k = find(params, p, lambda x: x[1] == self.parameter, len(params))
-                        if params[p:k] == self.autotokens[i:i+k]:
-                            p += k
-                            i += k
-                        else:
-                            return False
+                match = self.match_arguments(template, self.autotokens, self.find_delimiter)
             except IndexError:
                 return False
-            
-            # print(matched)
-            expansion = []
-            for t in body:
-                if t[1] == self.parameter:
-                    expansion.extend(matched[int(t[0])-1])
-                else:
-                    expansion.append(t)
-
-            # print(expansion)
-
-            self.tokens = expansion + self.tokens[i:]
+            if match is None:
+                return False
+            (matched, i) = match
+
+            expansion = None
+            if self.expansion_cache is not None and not self.expand_once and self.noexpand_followed_by is None:
+                expansion = self.memoized_expansion(defn, matched)
+            if expansion is None:
+                expansion = template.expand(matched)
+
+            self.tokens.drop(i)
+            self.tokens.push(expansion)
+            if self.limits is not None:
+                self.steps += 1
+                self.check_bounds()
             return True
         return False
 
+    def match_arguments(self, template, ts, find_delimiter):
+        # The arguments of the macro ts[0] with `template` and the number of
+        # tokens taken up by the macro and its arguments, or None if they do
+        # not match.  Raises IndexError if the tokens run out first.
+        i = 1
+        matched = []
+        if template.prefix:
+            k = len(template.prefix)
+            if template.prefix != ts[i:i+k]:
+                return None
+            i += k
+        for delimiter in template.delimiters:
+            if delimiter is None: # a non-delimited parameter
+                j = self.next_token_or_group(ts, i)
+                # TODO: also possibly match optional spaces
+                if j < 0: return None
+                if j - i > 0: # strip the group tokens
+                    matched.append(ts[i+1:j])
+                else:
+                    matched.append(ts[i:j+1])
+                i = j+1
+            else: # a delimited parameter
+                j = find_delimiter(i, delimiter)
+                matched.append(ts[i:j])
+                i = j + len(delimiter[0])
+        return (matched, i)
+
+    def memoized_expansion(self, defn, matched):
+        # The full expansion of the macro `defn` with arguments `matched`,
+        # taken from the expansion cache or expanded and cached, or None if
+        # it can not be memoized.
+        cache = self.expansion_cache
+        if sum(len(arg) for arg in matched) > cache.max_arguments:
+            return None
+        key = (id(defn), tuple(tuple(arg) for arg in matched))
+        entry = cache.get(key)
+        if entry is not None and entry[0] is defn:
+            for name, dep in entry[1]:
+                if self.definitions.get(name) is not dep:
+                    break
+            else:
+                if entry[2] is not None:
+                    cache.hits += 1
+                return entry[2]
+        if cache.hopeless(defn):
+            return None
+        cache.misses += 1
+        deps = []
+        expansion = self.expand_closed(defn.template.expand(matched), deps, cache.max_tokens)
+        cache.put(key, (defn, tuple(deps), expansion))
+        return expansion
+
+    def expand_closed(self, toks, deps, limit):
+        # Expands `toks` as if nothing followed them, until no expandable
+        # token is left.  Returns None if that needs more tokens, expands
+        # anything but macros (conditionals, \def and other commands have
+        # side effects), leaves a group token that could end a group between
+        # expansions, or takes more than `limit` tokens or expansions.  The
+        # names looked up are added to `deps`.
+        ts = InputStack()
+        ts.push(toks)
+        expansion = []
+        steps = 0
+        while len(ts) > 0:
+            t = ts[0]
+            if t[1] == self.control_sequence:
+                name = t[0]
+            elif t[1] == self.active:
+                name = (t[0],)
+            elif t[1] in (self.begin_group, self.end_group, self.command):
+                return None
+            else:
+                expansion.append(t)
+                ts.drop(1)
+                if len(expansion) > limit: return None
+                continue
+            defn = self.definitions.get(name)
+            deps.append((name, defn))
+            steps += 1
+            if not isinstance(defn, self.Functional) or steps > limit:
+                return None
+            find = lambda i, delimiter: self.find_delimiter(i, delimiter, ts)
+            try:
+                match = self.match_arguments(defn.template, ts, find)
+            except IndexError:
+                return None
+            if match is None:
+                return None
+            (matched, i) = match
+            ts.drop(i)
+            ts.push(defn.template.expand(matched))
+        return expansion
+
     __rules__['expander'].append(expander_expand_macro)
 
+    def lookahead(self, i):
+        # Yields the pending tokens from index i on, tokenizing more input
+        # when they run out.
+        while True:
+            for t in self.tokens.iter_from(i):
+                yield t
+                i += 1
+            while len(self.tokens) <= i:
+                if not self.tokenize():
+                    return
+
+    def find_delimiter(self, i, delimiter, tokens=None):
+        # Index of the first occurrence of the delimiter at or after i that is
+        # not inside a group, found in one pass with the KMP automaton, in
+        # `tokens` or by default in the pending tokens.
+        (tomatch, fail) = delimiter
+        q = 0
+        level = 0
+        for t in (self.lookahead(i) if tokens is None else tokens.iter_from(i)):
+            if level > 0:
+                if t[1] == self.begin_group: level += 1
+                elif t[1] == self.end_group: level -= 1
+            elif t[1] == self.begin_group:
+                level = 1
+                q = 0
+            else:
+                while q > 0 and t != tomatch[q]:
+                    q = fail[q-1]
+                if t == tomatch[q]:
+                    q += 1
+                    if q == len(tomatch):
+                        return i - q + 1
+            i += 1
+        raise IndexError(i)
+
+    def next_token_or_group(self, ts, i):
+        # index of the last token of the token or group starting at i
+        if ts[i][1] == self.begin_group:
+            g = 0
+            while True:
+                if ts[i][1] == self.begin_group: g = g + 1
+                elif ts[i][1] == self.end_group: g = g - 1
+                if g == 0:
+                    return i
+                i += 1
+        else:
+            return i
+
     def isbuiltin(self, token, type):
-        return (token[1] == self.control_sequence and token[0] in self.definitions 
-                and self.definitions[token[0]] == self.Builtin(type))
+        if token[1] != self.control_sequence: return False
+        defn = self.definitions.get(token[0])
+        return isinstance(defn, self.Builtin) and defn.type == type
+
+    conditionals = ('ifx', 'iftrue', 'iffalse')
 
     def isconditional(self, token):
-        conditionals = ('ifx', 'iftrue', 'iffalse')
-        return exists(lambda x: self.isbuiltin(token, x), conditionals)
+        if token[1] != self.control_sequence: return False
+        defn = self.definitions.get(token[0])
+        return isinstance(defn, self.Builtin) and defn.type in self.conditionals
 
 
+    @applies_to((control_sequence, 'ifx'), (control_sequence, 'iftrue'), (control_sequence, 'iffalse'))
     def expander_conditional(self):
         if (len(self.tokens) > 0 and self.tokens[0][1] == self.control_sequence
-            and self.tokens[0][0] in self.definitions
-            and isinstance(self.definitions[self.tokens[0][0]], self.Builtin)):
+            and isinstance(self.definitions.get(self.tokens[0][0]), self.Builtin)):
 
             type = self.definitions[self.tokens[0][0]][0]
             ts = self.autotokens
@@ -631,56 +1896,102 @@ class TeX():
             # true branch, continue expanding
             try:
                 if not cond: # False branch, skip to \else or \fi
-                    level = 0
-                    while True:
-                        if self.isconditional(ts[i]):
-                            level +=1
-                        elif self.isbuiltin(ts[i], 'else') and level == 0:
-                            i += 1
-                            break
-                        elif self.isbuiltin(ts[i], 'fi'):
-                            if level == 0: break
-                            else: level -= 1
+                    i = self.skip_conditional(i, True)
+                    if self.isbuiltin(self.tokens[i], 'else'):
                         i += 1
             except IndexError:
                 return False
 
-            self.tokens = self.tokens[i:]
+            self.tokens.drop(i)
             return True
         return False
 
     __rules__['expander'].append(expander_conditional)
 
+    skip_types = conditionals + ('else', 'fi')
+
+    def skip_names(self):
+        # The names bound to conditionals, to \else and to \fi
+        if self.skip_cache is None or self.skip_cache[0] != self.definitions.skip_version:
+            names = dict((type, set()) for type in self.skip_types)
+            for name, defn in self.definitions.items():
+                if self.definitions.affects_skipping(defn):
+                    names[defn.type].add(name)
+            conditionals = frozenset().union(*[names[type] for type in self.conditionals])
+            self.skip_cache = (self.definitions.skip_version, conditionals,
+                frozenset(names['else']), frozenset(names['fi']),
+                conditionals | names['else'] | names['fi'])
+        return self.skip_cache[1:]
+
+    def skip_conditional(self, i, to_else):
+        # Index of the \fi, or \else if `to_else`, that ends the conditional
+        # text starting at index i.  Raises IndexError if the input ends first.
+        (conditionals, elses, fis, names) = self.skip_names()
+        level = 0
+        while True:
+            for t in self.tokens.iter_from(i):
+                if t[1] == self.control_sequence:
+                    if t[0] in conditionals:
+                        level += 1
+                    elif t[0] in elses and level == 0 and to_else:
+                        return i
+                    elif t[0] in fis:
+                        if level == 0: return i
+                        level -= 1
+                i += 1
+            if not self.skip_input(names):
+                raise IndexError(i)
+
+    def skip_input(self, names):
+        # Reads input up to the next control sequence in `names` and appends
+        # its token, without tokenizing the text before it.
+        while True:
+            if self.line == '' and not self.tokenizer_read_line():
+                return False
+            if self.scanner is None or self.scanner.version != self.catcode.version:
+                self.scanner = self.Scanner(self.catcode, self.cs_tokens)
+            t, pos = self.scanner.skip(self.line, self.line_pos, names)
+            if t is None and len(self.skipped) < 75:
+                # the start of the text skipped so far, see diagnostic
+                self.skipped += self.line[self.line_pos:pos]
+            invalid = t is None and pos < len(self.line)
+            if invalid: pos += 1
+            if pos >= len(self.line):
+                self.line = ''
+                self.line_pos = 0
+            else:
+                self.line_pos = pos
+            if invalid: raise InvalidCharacter()
+            if t is not None:
+                self.skipped = ''
+                self.state = self.skipping
+                self.scan_mark = None
+                self.tokens.append(t)
+                return True
+
+    @applies_to((control_sequence, 'else'))
     def expand_else(self):
         if len(self.tokens) > 0 and self.isbuiltin(self.tokens[0], 'else'):
             if self.condition_level == 0:
                 raise TeXError("Lone \\else scanned")
-            ts = self.autotokens
             # skip to \fi
-            i = 1
-            level = 0
             try:
-                while True:
-                    if self.isconditional(ts[i]):
-                        level +=1
-                    elif self.isbuiltin(ts[i], 'fi'):
-                        if level == 0: break
-                        else: level -= 1
-                    i += 1
+                i = self.skip_conditional(1, False)
             except IndexError:
                 return False
 
             self.condition_level -= 1
-            self.tokens = self.tokens[i+1:]
+            self.tokens.drop(i+1)
 
             return True
         return False
 
     __rules__['expander'].append(expand_else)
 
+    @applies_to((control_sequence, 'fi'))
     def expand_fi(self):
         if len(self.tokens) > 0 and self.isbuiltin(self.tokens[0], 'fi'):
-            self.tokens = self.tokens[1:]
+            self.tokens.drop(1)
             if self.condition_level == 0:
                 raise TeXError("Lone \\fi scanned.")
             self.condition_level -= 1
@@ -689,144 +2000,200 @@ class TeX():
 
     __rules__['expander'].append(expand_fi)
 
+    @applies_to((control_sequence, 'relax'))
     def expand_relax(self):
         if len(self.tokens) > 0 and self.isbuiltin(self.tokens[0], 'relax'):
-            self.tokens = self.tokens[1:]
+            self.tokens.drop(1)
             return True
         return False
 
     __rules__['expander'].append(expand_relax)
 
+    @applies_to((control_sequence, 'expandafter'))
     def expand_expandafter(self):
         if len(self.tokens) > 0 and self.isbuiltin(self.tokens[0], 'expandafter'):
             ts = self.autotokens
-            t = ts[1] # the token to skip
-            _ = ts[2] # read after the first token to trigger tokenisation
-            self.tokens = self.tokens[2:]
-            self.expand()
-            self.tokens = [t] + self.tokens
+            try:
+                t = ts[1] # the token to skip
+                _ = ts[2] # read after the first token to trigger tokenisation
+            except IndexError:
+                return False
+            expandafter = ts[0]
+            self.tokens.drop(2)
+            # only one level of the expansion, see expander_expand_macro
+            self.expand_once = True
+            expanded = self.expand()
+            self.expand_once = False
+            if (not expanded and not self.input.closed
+                and self.tokens[0][1] in (self.control_sequence, self.active)):
+                # the arguments may still be fed, see StreamSource
+                self.tokens.push([expandafter, t])
+                return False
+            self.tokens.push([t])
             return True
         return False
 
     __rules__['expander'].append(expand_expandafter)
 
 
+    @applies_to((control_sequence, 'csname'))
     def expand_csname(self):
         if len(self.tokens) > 0 and self.isbuiltin(self.tokens[0], 'csname'):
-            self.tokens = self.tokens[1:]
             ts = self.autotokens
+            scanned = [ts[0]]
+            self.tokens.drop(1)
             toks = []
-            while True:
-                if self.isbuiltin(ts[0], 'endcsname'):
-                    self.tokens = self.tokens[1:]
-                    break
-                if ts[0][1] == self.control_sequence:
-                    if ts[0][0] in self.definitions:
-                        self.expand()
+            try:
+                while True:
+                    if self.isbuiltin(ts[0], 'endcsname'):
+                        self.tokens.drop(1)
+                        break
+                    if ts[0][1] == self.control_sequence:
+                        if ts[0][0] in self.definitions:
+                            if not self.expand():
+                                raise IndexError("Arguments of `%s' not available" % ts[0][0])
+                        else:
+                            raise TeXError("Undefined control sequence `%s'" % ts[0][0])
+                    elif ts[0][1] == self.command:
+                        raise TeXError("Primitve command found `%s' while processing \\csname." % ts[0][0])
                     else:
-                        raise TeXError("Undefined control sequence `%s'" % ts[0][0])
-                elif ts[0][1] == self.command:
-                    raise TeXError("Primitve command found `%s' while processing \\csname." % ts[0][0])
-                else:
-                    toks.append(ts[0][0])
-                    self.tokens = self.tokens[1:]
+                        toks.append(ts[0][0])
+                        scanned.append(ts[0])
+                        self.tokens.drop(1)
+            except IndexError:
+                # the name may still be fed, see StreamSource
+                self.tokens.push(scanned)
+                return False
 
             name = ''.join(toks)
             if not name in self.definitions:
                 self.definitions[name] = self.Builtin('relax')
 
-            self.tokens.insert(0, (name, self.control_sequence))
+            cs = (name, self.control_sequence)
+            self.tokens.push([self.cs_tokens.setdefault(cs, cs)])
             return True
         return False
 
     __rules__['expander'].append(expand_csname)
 
 
+    @applies_to((begin_group, None))
     def command_open_group(self):
         if len(self.tokens) > 0 and self.tokens[0][1] == self.begin_group:
             self.definitions.push()
-            self.tokens = self.tokens[1:]
+            self.tokens.drop(1)
             return True
         return False
 
     __rules__['command'].append(command_open_group)
 
     
+    @applies_to((end_group, None))
     def command_close_group(self):
         if len(self.tokens) > 0 and self.tokens[0][1] == self.end_group:
+            if self.definitions.depth() == 0:
+                raise TeXError("Too many }'s on line %d of file %s." % (self.line_num, self.file))
             self.definitions.pop()
-            self.tokens = self.tokens[1:]
+            self.tokens.drop(1)
             return True
         return False
 
     __rules__['command'].append(command_close_group)
 
+    @applies_to(*[(c, None) for c in (0, 3, 4, 5, 6, 7, 8, 10, 11, 12)])
     def command_token(self):
         if len(self.tokens) > 0 and self.tokens[0][1] in (0, 3, 4, 5, 6, 7, 8, 10, 11, 12):
             self.process_token(self.tokens[0])
-            self.tokens = self.tokens[1:]
+            self.tokens.drop(1)
             return True
         return False
     
     __rules__['command'].append(command_token)
 
     def save_token_state(self):
-        self.token_state.append( (self.tokens, self.line, self.input, self.line_num, self.file) )
+        self.token_state.append( (self.tokens, self.line, self.line_pos, self.input, self.input_pos, self.line_num, self.file, self.line_cache) )
 
     def restore_token_state(self):
-        (t, l, i, n, f) = self.token_state.pop()
+        (t, l, p, i, k, n, f, c) = self.token_state.pop()
         self.tokens = t
         self.line = l
+        self.line_pos = p
         self.input = i
+        self.input_pos = k
         self.line_num = n
         self.file = f
+        self.line_cache = c
 
     def command_input(self):
-        self.tokens = self.tokens[1:]
         ts = self.autotokens
+        scanned = [ts[0]]
+        self.tokens.drop(1)
         file = []
         # scan filename while expanding controll sequences
-        while True:
-            if ts[0][1] == self.space:
-                self.tokens = self.tokens[1:]
-                break
-            elif ts[0][1] == self.command:
-                break
-            elif ts[0][1] == self.control_sequence:
-                self.expand()
-            else:
-                file.append(ts[0][0])
-                self.tokens = self.tokens[1:]
+        try:
+            while True:
+                if ts[0][1] == self.space:
+                    self.tokens.drop(1)
+                    break
+                elif ts[0][1] == self.command:
+                    break
+                elif ts[0][1] == self.control_sequence:
+                    if not self.expand():
+                        raise IndexError("Arguments of `%s' not available" % ts[0][0])
+                else:
+                    file.append(ts[0][0])
+                    scanned.append(ts[0])
+                    self.tokens.drop(1)
+        except IndexError:
+            # the name may still be fed, see StreamSource
+            self.tokens.push(scanned)
+            return False
 
         filename = ''.join(file)
 
         try:
-            handle = open(filename, 'r')
+            source = self.open_source(filename)
+            # the rest of the line is tokenized after the file is read
+            self.retokenize()
             self.save_token_state()
-            self.tokens = []
+            self.tokens = InputStack()
             self.line = ''
-            self.input = handle.read()
+            self.line_pos = 0
+            self.input = source
+            self.input_pos = 0
             self.line_num = 0
             self.file = filename
-            handle.close()
+            # the tokens of the lines of the file as read with the current
+            # category codes, valid until the next \catcode
+            self.line_cache = None
+            if self.token_cache is not None:
+                key = self.token_cache.key(filename, self.catcode)
+                self.line_cache = (self.token_cache.lines(key), self.catcode.version, key)
         except FileNotFoundError:
             raise TeXError("File not found `%s'" % filename)
 
     __commands__['input'] = command_input
 
+    def open_source(self, filename):
+        return FileSource(filename)
+
     def command_endinput(self):
-        self.tokens = self.tokens[1:]
+        self.tokens.drop(1)
         if len(self.token_state) > 0:
             self.restore_token_state()
         else:
-            self.tokens = []
-            self.input = ''
+            self.tokens = InputStack()
+            self.input = StringSource('')
+            self.input_pos = 0
             self.line = ''
+            self.line_pos = 0
 
     __commands__['endinput'] = command_endinput
 
+    @applies_to(None)
     def command_input_ended(self):
-        if self.tokens == [] and self.input == '' and self.line == '' and len(self.token_state) > 0:
+        if (len(self.tokens) == 0 and self.input.at_end(self.input_pos) and self.input.closed
+            and self.line == '' and len(self.token_state) > 0):
             self.restore_token_state()
             return True
         return False
@@ -834,7 +2201,7 @@ class TeX():
     __rules__['command'].append(command_input_ended)
 
     def command_par(self):
-        self.tokens = self.tokens[1:]
+        self.tokens.drop(1)
         self.process_par()
 
     __commands__['par'] = command_par
@@ -852,6 +2219,8 @@ class TeX():
             ('char', 'n ', lambda x: chr(int(x[0]))),
         ]
         res = recursive_descent_matcher(rules, 'char', 1, self.autotokens)
+        if not self.input.closed and self.scan_pending(res, self.autotokens):
+            return False
         if res == None:
             raise TeXError("Failed to parse a character number")
 
@@ -860,7 +2229,8 @@ class TeX():
         if (len(r) > 1):
             raise TeXError("A single charecter control sequence is expected")
 
-        self.tokens = [(r, self.other)] + self.tokens[i:]
+        self.tokens.drop(i)
+        self.tokens.push([token(r, self.other)])
 
     __commands__['char'] = command_char
 
@@ -877,10 +2247,17 @@ class TeX():
             ('i', 'n ', lambda x: int(x[0])),
             ('catcode', '`t=i ', lambda x: (x[1], x[3]))
         ]
-        self.noexpand_followed_by = ('`', self.other)
-        self.tokens = self.tokens[1:]
+        self.noexpand_followed_by = token('`', self.other)
+        catcode = self.tokens[0]
+        self.tokens.drop(1)
         res = recursive_descent_matcher(rules, 'catcode', 0, self.autoexpandtokens)
         self.noexpand_followed_by = None
+        if not self.input.closed and self.scan_pending(res, self.autoexpandtokens):
+            # scan again once more input is fed, the expansions are kept
+            self.tokens.push([catcode] + list(self.expanded_tokens))
+            self.expanded_tokens = TokenQueue()
+            self.no_expand = False
+            return False
         if res == None:
             raise TeXError("Failed to parse a catcode")
 
@@ -893,21 +2270,40 @@ class TeX():
             raise TeXError("Unknown category code %d" % n)
 
         self.catcode[t] = n
+        self.retokenize()
 
         leftover = self.expanded_tokens[i:]
-        self.tokens = leftover + self.tokens
-        self.expanded_tokens = []
+        self.tokens.push(leftover)
+        self.expanded_tokens = TokenQueue()
 
 
     __commands__['catcode'] = command_catcode
 
+    def scan_pending(self, res, ts):
+        # Whether the match of recursive_descent_matcher may change with more
+        # input: it failed, or it ends at the end of the tokens read so far
+        # where a number could go on and the optional space could follow
+        if res is None:
+            return True
+        i = res[1]
+        if i > 0 and ts[i - 1][1] == self.space:
+            return False
+        try:
+            ts[i]
+            return False
+        except IndexError:
+            return True
+
     def command_let(self):
 
         ts = self.autotokens
 
-        cs = ts[1]
-        eq = ts[2]
-        t = ts[3]
+        try:
+            cs = ts[1]
+            eq = ts[2]
+            t = ts[3]
+        except IndexError:
+            return False
 
         # TODO cs could be also active character
         if not cs[1] == self.control_sequence:
@@ -917,15 +2313,12 @@ class TeX():
             raise TeXError("Character = expected while handling \\let")
 
         if t[1] == self.control_sequence:
-            if t[0] in self.definitions:
-                self.definitions[cs[0]] = self.definitions[t[0]]
-            else:
-                # TODO: should be undefined for the current group level
-                self.definitions[cs[0]] = None
+            # TODO: should be undefined for the current group level
+            self.definitions[cs[0]] = self.definitions.get(t[0])
         else:
             raise TeXError("Other than control sequences are currently not handled by \\let")
 
-        self.tokens = self.tokens[4:]
+        self.tokens.drop(4)
 
     __commands__['let'] = command_let
 
@@ -933,18 +2326,19 @@ class TeX():
         pass
 
     def process_token(self, token):
-        print (token[0], end='')
+        self.output.write(token[0])
         # raise NotImplementedError
         
     def process_command(self, cmd):
-        print("Command", cmd)
+        self.output.write("Command %s\n" % cmd)
         return False
 
     def process_par(self):
-        print()
+        self.output.write('\n')
+        self.output.flush()
 
     def define_command_macro(self, cmd):
-        self.definitions[cmd] = self.Functional([], [(cmd, self.command)])
+        self.definitions[cmd] = self.Functional([], [token(cmd, self.command)])
 
 
 
@@ -957,24 +2351,375 @@ class TeXOutputStdout(TeX):
         #     self.define_command_macro(c)
 
     def process_par(self):
-        print()
+        self.output.write('\n')
+        self.output.flush()
 
     def process_token(self, t):
-        c = t[0]
-        print(c, sep='', end='')
+        self.output.write(t[0])
 
     def process_command(self, cmd):
         return False
 
 
+def process_checked(t):
+    # Runs t and returns a description of the error that stopped it, if any.
+    try:
+        t.process()
+    except (TeXError, InvalidCharacter) as e:
+        return describe_error(t, e)
+    return describe_error(t)
+
+def describe_error(t, e=None):
+    # Describes the exception e that stopped t or, without one, the input
+    # that t could not process, if there is any.
+    if isinstance(e, LimitExceeded):
+        return {'type': 'LimitExceeded', 'limit': e.limit, 'message': str(e)}
+    if isinstance(e, TeXError):
+        return {'type': 'TeXError', 'message': str(e)}
+    if isinstance(e, InvalidCharacter):
+        return {'type': 'InvalidCharacter', 'message': 'Invalid character on line %d' % t.line_num}
+    message = t.diagnostic()
+    if message is not None:
+        return {'type': 'stuck', 'message': message}
+    return None
+
+def render(text, fmt=None, cls=TeXOutputStdout, limits=None, expansion_cache=None):
+    # Processes `text` starting from the format `fmt` and returns a response
+    # with the output and, if processing failed, an error.
+    chunks = []
+    t = cls(text, output=chunks.append, fmt=fmt, limits=limits, expansion_cache=expansion_cache)
+    error = process_checked(t)
+    return {'output': ''.join(chunks), 'error': error}
+
+def render_stream(chunks, fmt=None, cls=TeXOutputStdout):
+    # Processes the strings of `chunks` as they arrive, starting from the
+    # format `fmt`, and yields the output as it is produced.  Raises TeXError
+    # if some of the input could not be processed.
+    t = cls(StreamSource(), fmt=fmt)
+    yield from t.iter_output(chunks)
+    message = t.diagnostic()
+    if message is not None:
+        raise TeXError(message)
+
+def read_file(filename, encoding=None):
+    # The text of a file as FileSource reads it.
+    with open(filename, 'rb') as handle:
+        data = handle.read()
+    return data.replace(b'\r\n', b'\n').decode(encoding or locale.getpreferredencoding(False))
+
+async def iter_output_async(t, slice_steps=1000):
+    # Processes t in slices of `slice_steps` steps and yields the output of
+    # each slice, letting other tasks run in between.  Files are read by
+    # \input in a thread while t waits for them.  The work done is bounded
+    # by the limits of t; cancelling the task stops t after the current
+    # slice.
+    import asyncio
+    loop = asyncio.get_running_loop()
+    reads = []
+    def open_source(filename):
+        source = StreamSource()
+        reads.append((source, filename, loop.run_in_executor(None, read_file, filename)))
+        return source
+    produced = []
+    target, t.output.target = t.output.target, produced.append
+    t.open_source = open_source
+    try:
+        while True:
+            n = t.process_steps(slice_steps)
+            t.output.flush()
+            ready, produced[:] = produced[:], []
+            for chunk in ready:
+                yield chunk
+            if n == slice_steps:
+                await asyncio.sleep(0)
+            elif reads:
+                (source, filename, future) = reads.pop(0)
+                try:
+                    source.feed(await future)
+                except FileNotFoundError:
+                    raise TeXError("File not found `%s'" % filename)
+                source.close()
+            else:
+                break
+    finally:
+        for (_, _, future) in reads:
+            future.cancel()
+        del t.open_source
+        t.output.target = target
+        if t.token_cache is not None:
+            t.token_cache.save()
+
+async def render_async(text, fmt=None, cls=TeXOutputStdout, limits=None, slice_steps=1000):
+    # Like render, but runs in the event loop, see iter_output_async.
+    chunks = []
+    t = cls(text, output=chunks.append, fmt=fmt, limits=limits)
+    try:
+        async for chunk in iter_output_async(t, slice_steps):
+            chunks.append(chunk)
+    except (TeXError, InvalidCharacter) as e:
+        return {'output': ''.join(chunks), 'error': describe_error(t, e)}
+    return {'output': ''.join(chunks), 'error': describe_error(t)}
+
+worker_snapshot = None
+worker_limits = None
+worker_expansion_cache = None
+
+def init_worker(fmt, limits=None, memoize=False):
+    # Each worker loads the format once and starts every document from a
+    # snapshot of it.  The documents share the expansions of the macros of
+    # the format.
+    global worker_snapshot, worker_limits, worker_expansion_cache
+    worker_snapshot = TeX(fmt=fmt).snapshot()
+    worker_limits = limits
+    worker_expansion_cache = ExpansionCache() if memoize else None
+
+def worker_pool(fmt, workers=None, limits=None, memoize=False):
+    # Where processes can be forked the workers inherit `fmt` from this
+    # process instead of having it sent to each of them.
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    return ProcessPoolExecutor(workers, mp_context=context, initializer=init_worker, initargs=(fmt, limits, memoize))
+
+def render_request(request):
+    response = render(request['input'], worker_snapshot, limits=worker_limits, expansion_cache=worker_expansion_cache)
+    if 'id' in request:
+        response['id'] = request['id']
+    return response
+
+def render_file(path, out_path):
+    start = time.perf_counter()
+    # the output replaces out_path only if the file is rendered
+    temporary = '%s.%d.tmp' % (out_path, os.getpid())
+    try:
+        if os.path.abspath(path) == os.path.abspath(out_path):
+            raise OSError("Output would overwrite the input " + path)
+        source = FileSource(path)
+        with open(temporary, 'w', encoding='utf-8') as out:
+            error = process_checked(TeXOutputStdout(source, output=out, fmt=worker_snapshot, limits=worker_limits,
+                                                     expansion_cache=worker_expansion_cache))
+        if error is None:
+            os.replace(temporary, out_path)
+    except Exception as e:
+        # also errors that process_checked does not describe, so that one
+        # file can not stop the others
+        error = {'type': type(e).__name__, 'message': str(e)}
+    if error is not None and os.path.exists(temporary):
+        os.remove(temporary)
+    return (path, out_path, time.perf_counter() - start, error)
+
+def render_batch(paths, fmt=None, outdir=None, suffix='.out', workers=None, report=sys.stderr, limits=None, memoize=False):
+    # Renders each file in `paths` starting from the format `fmt` to a file
+    # with the same name but the extension `suffix`, in `outdir` or next to
+    # the input.  Files are rendered in parallel by a pool of worker
+    # processes and a line with the time taken or the error is written to
+    # `report` as each one finishes.  A file whose output would be written
+    # by an earlier file fails.  Returns the number of failed files.
+    from concurrent.futures import as_completed
+    start = time.perf_counter()
+    failed = 0
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+    with worker_pool(fmt, workers, limits, memoize) as pool:
+        futures = []
+        writers = {}
+        for path in paths:
+            out_path = os.path.splitext(path)[0] + suffix
+            if outdir is not None:
+                out_path = os.path.join(outdir, os.path.basename(out_path))
+            key = os.path.abspath(out_path)
+            if key in writers:
+                failed += 1
+                report.write('%s FAILED 0.000s OSError: Output %s is also written for %s\n' % (path, out_path, writers[key]))
+                continue
+            writers[key] = path
+            futures.append(pool.submit(render_file, path, out_path))
+        for future in as_completed(futures):
+            (path, out_path, seconds, error) = future.result()
+            if error is None:
+                report.write('%s -> %s %.3fs\n' % (path, out_path, seconds))
+            else:
+                failed += 1
+                report.write('%s FAILED %.3fs %s: %s\n' % (path, seconds, error['type'], error['message']))
+    report.write('%d files, %d failed, %.3fs\n' % (len(paths), failed, time.perf_counter() - start))
+    return failed
+
+def serve(fmt=None, socket_path=None, workers=None, limits=None, memoize=False):
+    # Answers requests of the form {"id": ..., "input": "..."}, one JSON
+    # object per line, on stdin or on connections to a Unix socket.  Every
+    # request is rendered by a pool of worker processes from a fresh TeX
+    # that starts from `fmt`; responses carry the id of their request and
+    # may arrive out of order.
+    import functools
+    import json
+    import threading
+
+    pool = worker_pool(fmt, workers, limits, memoize)
+
+    def handle(lines, write):
+        lock = threading.Lock()
+        def respond(response):
+            with lock:
+                write(json.dumps(response) + '\n')
+        finished = threading.Semaphore(0)
+        def done(request, future):
+            try:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    response = {'output': '', 'error': {'type': type(e).__name__, 'message': str(e)}}
+                    if 'id' in request:
+                        response['id'] = request['id']
+                respond(response)
+            finally:
+                finished.release()
+        submitted = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict) or not isinstance(request.get('input'), str):
+                    raise ValueError('A request must be an object with an "input" string')
+            except ValueError as e:
+                respond({'output': '', 'error': {'type': 'request', 'message': str(e)}})
+                continue
+            future = pool.submit(render_request, request)
+            future.add_done_callback(functools.partial(done, request))
+            submitted += 1
+        for _ in range(submitted):
+            finished.acquire()
+
+    try:
+        if socket_path is None:
+            def write(text):
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            handle(sys.stdin, write)
+        else:
+            import socketserver
+            class Handler(socketserver.StreamRequestHandler):
+                def handle(self):
+                    wfile = self.wfile
+                    def write(text):
+                        wfile.write(text.encode('utf-8'))
+                        wfile.flush()
+                    handle(io.TextIOWrapper(self.rfile, encoding='utf-8'), write)
+            remove_stale_socket(socket_path)
+            with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+                try:
+                    server.serve_forever()
+                finally:
+                    os.remove(socket_path)
+    finally:
+        pool.shutdown()
+
+def remove_stale_socket(path):
+    # Removes the socket file left at `path` by a server that stopped
+    # without removing it, which would keep a new server from binding to
+    # it.  Other files are left alone.
+    import stat
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
 if __name__ == "__main__":
-    import sys
-    file = sys.argv[1]
-    f = open(file, 'r')
-    content = f.read()
-    f.close()
-    t = TeXOutputStdout(content)
-    t.run()
+    import argparse
+    parser = argparse.ArgumentParser(description='Expand the macros of a plain TeX file.')
+    parser.add_argument('file', nargs='?', help="the input, or - to process stdin as it arrives")
+    parser.add_argument('--fmt', help='start from the definitions in a format file')
+    parser.add_argument('--dump', metavar='FMT', help='write the definitions to a format file after the input is processed')
+    parser.add_argument('--serve', action='store_true', help='answer JSON requests on stdin, after processing file')
+    parser.add_argument('--batch', nargs='+', metavar='INPUT', help='render each INPUT, after processing file')
+    parser.add_argument('--outdir', help='with --batch, the directory for output files')
+    parser.add_argument('--suffix', default='.out', help='with --batch, the extension of output files')
+    parser.add_argument('--socket', metavar='PATH', help='with --serve, listen on a Unix socket instead of stdin')
+    parser.add_argument('--workers', type=int, help='with --serve, the number of worker processes')
+    parser.add_argument('--profile', metavar='OUT', nargs='?', const='-', help='time the expansion of every macro and write a report to stderr or OUT, as JSON if OUT ends in .json and in pstats format otherwise')
+    parser.add_argument('--max-steps', type=int, help='stop a document after this many steps')
+    parser.add_argument('--max-depth', type=int, help='stop a document when expansions are nested deeper than this')
+    parser.add_argument('--max-tokens', type=int, help='stop a document when more tokens than this are pending')
+    parser.add_argument('--max-inputs', type=int, help='stop a document when \\input files are nested deeper than this')
+    parser.add_argument('--timeout', type=float, help='stop a document after this many seconds')
+    parser.add_argument('--flamegraph', metavar='OUT', help='write the time spent in every chain of macro expansions to OUT, in the collapsed format of flame graph tools')
+    parser.add_argument('--sample', metavar='SECONDS', type=float, help='with --flamegraph, sample the chains at this interval instead of timing every step')
+    parser.add_argument('--metrics', action='store_true', help='write counters of the work done as JSON to stderr')
+    parser.add_argument('--memoize', action='store_true', help='reuse the full expansions of macros that have no side effects')
+    parser.add_argument('--token-cache', metavar='DIR', help='keep the tokens of \\input files in DIR for later runs')
+    args = parser.parse_args()
+    if args.file is None and not args.serve and not args.batch:
+        parser.error('the file argument is required')
+    fmt = args.fmt
+    limits = TeX.Limits(args.max_steps, args.max_depth, args.max_tokens, args.max_inputs, args.timeout)
+    if limits == TeX.Limits():
+        limits = None
+    if args.file is not None:
+        token_cache = TokenCache(args.token_cache)
+        expansion_cache = ExpansionCache() if args.memoize else None
+        if args.file == '-':
+            t = TeXOutputStdout(StreamSource(), fmt=fmt, token_cache=token_cache, limits=limits, expansion_cache=expansion_cache)
+        else:
+            t = TeXOutputStdout(FileSource(args.file), fmt=fmt, token_cache=token_cache, limits=limits,
+                                expansion_cache=expansion_cache)
+        profiler = metrics = None
+        if args.profile is not None or args.flamegraph is not None:
+            if args.flamegraph is None:
+                profiler = Profiler(t)
+            elif args.sample is None:
+                profiler = Profiler(t, stacks='exact')
+            else:
+                profiler = Profiler(t, stacks='sample', interval=args.sample)
+            profiler.enable()
+        if args.metrics:
+            metrics = Metrics(t)
+            metrics.enable()
+        if args.file == '-':
+            for chunk in t.iter_output(sys.stdin):
+                sys.stdout.write(chunk)
+                sys.stdout.flush()
+            message = t.diagnostic()
+            if message is not None:
+                print(message)
+        else:
+            t.run()
+        if profiler is not None:
+            profiler.disable()
+            if args.flamegraph is not None:
+                with open(args.flamegraph, 'w') as handle:
+                    profiler.dump_collapsed(handle)
+            if args.profile is None:
+                pass
+            elif args.profile == '-':
+                profiler.report()
+            elif args.profile.endswith('.json'):
+                with open(args.profile, 'w') as handle:
+                    profiler.dump_json(handle)
+            else:
+                profiler.dump_stats(args.profile)
+        if metrics is not None:
+            import json
+            metrics.disable()
+            json.dump(metrics.snapshot(), sys.stderr, indent=1)
+            sys.stderr.write('\n')
+        if args.dump or args.serve or args.batch:
+            fmt = t.dump_format()
+        if args.dump:
+            with open(args.dump, 'wb') as handle:
+                handle.write(fmt)
+    if isinstance(fmt, str):
+        with open(fmt, 'rb') as handle:
+            fmt = handle.read()
+    if args.batch:
+        if render_batch(args.batch, fmt, args.outdir, args.suffix, args.workers, limits=limits, memoize=args.memoize):
+            sys.exit(1)
+    if args.serve:
+        serve(fmt, args.socket, args.workers, limits, args.memoize)
 
 
 # t = TeX("\\xyz{}\\def\\hello#1 #2{world #2} hello { xx }  \\code x \n\n  \n\n, w\norld!")